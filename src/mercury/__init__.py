@@ -1,4 +1,5 @@
 from mercury.repo import Repository, Changeset
 from mercury.queryset import Queryset
+from mercury.status import StatusWatcher
 
-__all__ = ['Repository', 'Changeset', 'Queryset']
+__all__ = ['Repository', 'Changeset', 'Queryset', 'StatusWatcher']
@@ -0,0 +1,408 @@
+"""Apply the Changes that diffparser.parse() returns to file contents held
+in memory, without touching a working directory or running hg.
+
+  from mercury import apply, diffparser
+
+  result = apply.apply_change(change, old_text)
+  if result.ok:
+      new_text = result.text
+
+Hunks are applied as GNU patch and `hg import' would: if a hunk's old
+lines aren't where it says they should be, we look for them elsewhere in
+the file (an offset), and failing that, try ignoring a few lines of its
+context at either end (fuzz).  Hunks that still don't fit are rejected
+and reported, rather than raising an exception, so that large numbers of
+patches can be checked cheaply; see ChangeResult.ok."""
+
+from mercury.change import Add, Delete, Copy, Rename
+from mercury.exceptions import *
+
+# How much context apply_hunks() will ignore by default, as for GNU patch
+DEFAULT_FUZZ = 2
+
+class HunkResult(object):
+    """Describes how a single hunk was applied.
+
+    Attributes:
+
+      hunk    - the TextHunk
+      applied - True if the hunk was applied, False if it was rejected
+      line    - the line of the old text (numbered from 1) at which the
+                hunk was applied, or None if it was rejected
+      offset  - the number of lines between where the hunk said it applied
+                and where it actually did
+      fuzz    - the number of lines of context that were ignored"""
+
+    def __init__(self, hunk, line=None, offset=0, fuzz=0):
+        self.hunk = hunk
+        self.applied = line is not None
+        self.line = line
+        self.offset = offset
+        self.fuzz = fuzz
+
+    def __repr__(self):
+        if not self.applied:
+            return '<HunkResult %r rejected>' % (self.hunk,)
+        return '<HunkResult %r at line %d, offset %d, fuzz %d>' \
+               % (self.hunk, self.line, self.offset, self.fuzz)
+
+class ChangeResult(object):
+    """The result of applying a Change.
+
+    Attributes:
+
+      change - the Change
+      source - the path the old text came from, or None if the file was
+               created
+      dest   - the path the new text belongs at, or None if the file was
+               deleted
+      text   - the new text, or None if the file was deleted
+      mode   - the new mode of the file, if the Change gives one, or None
+      hunks  - a list of HunkResults, one per text hunk
+      error  - None, or a message describing why the Change could not be
+               applied at all (a missing file, say)
+
+    When hunks are rejected, `text' holds the result of applying the rest
+    of them."""
+
+    def __init__(self, change, source, dest, text=None, mode=None,
+                 hunks=None, error=None):
+        self.change = change
+        self.source = source
+        self.dest = dest
+        self.text = text
+        self.mode = mode
+        self.hunks = hunks or []
+        self.error = error
+
+    @property
+    def rejected(self):
+        """The HunkResults for the hunks that could not be applied."""
+        return [h for h in self.hunks if not h.applied]
+
+    @property
+    def ok(self):
+        """True if the whole Change applied cleanly (possibly with offsets
+        or fuzz)."""
+        return self.error is None and not self.rejected
+
+    def __repr__(self):
+        if self.error is not None:
+            status = 'error %r' % self.error
+        else:
+            status = '%d/%d hunks applied' % (len(self.hunks)
+                                              - len(self.rejected),
+                                              len(self.hunks))
+        return '<ChangeResult %r: %s>' % (self.change, status)
+
+def _split_lines(text):
+    """Split `text' into lines, each keeping its line ending; unlike
+    splitlines(), only '\\n' ends a line."""
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+def _strip_newline(text):
+    if text.endswith('\r\n'):
+        return text[:-2]
+    elif text.endswith('\n'):
+        return text[:-1]
+    return text
+
+def _hunk_sides(hunk, reverse):
+    """Return (old, new, top, bottom) for `hunk', where `old' and `new'
+    are its lines before and after, and `top' and `bottom' are the number
+    of lines of context at its start and end."""
+    if reverse:
+        remove, add = '+', '-'
+    else:
+        remove, add = '-', '+'
+
+    old = []
+    new = []
+    top = bottom = 0
+    changed = False
+    last = None
+    for op, text in hunk.lines:
+        if op == '\\':
+            # A "\ No newline at end of file" in the middle of the hunk
+            # applies to the line before it
+            if last in (' ', remove) and old:
+                old[-1] = _strip_newline(old[-1])
+            if last in (' ', add) and new:
+                new[-1] = _strip_newline(new[-1])
+            continue
+        last = op
+        if op == ' ':
+            old.append(text)
+            new.append(text)
+            if changed:
+                bottom += 1
+            else:
+                top += 1
+        elif op == remove:
+            old.append(text)
+            changed = True
+            bottom = 0
+        elif op == add:
+            new.append(text)
+            changed = True
+            bottom = 0
+    if not changed:
+        bottom = 0
+    return old, new, top, bottom
+
+def _find(lines, old, expected, lo):
+    """Return the position at or after `lo' closest to `expected' at which
+    `old' appears in `lines', or None."""
+    size = len(old)
+    hi = len(lines) - size
+    if hi < lo:
+        return None
+    expected = min(max(expected, lo), hi)
+    first = old[0]
+    for distance in xrange(max(expected - lo, hi - expected) + 1):
+        for pos in (expected - distance, expected + distance):
+            if lo <= pos <= hi and lines[pos] == first \
+                   and lines[pos:pos + size] == old:
+                return pos
+            if not distance:
+                break
+    return None
+
+def apply_hunks(text, hunks, reverse=False, fuzz=DEFAULT_FUZZ):
+    """Apply a list of TextHunks to `text'; returns a tuple of the new text
+    and a list of HunkResults.
+
+    reverse - if True, undo the hunks instead
+    fuzz    - the most lines of context to ignore at either end of a hunk
+              that doesn't otherwise apply
+
+    Hunks must be in order, as they are in a diff, and are never applied
+    over one another.  Hunks that don't apply are left out of the new
+    text."""
+    lines = _split_lines(text)
+    out = []
+    results = []
+    cursor = 0
+    skew = 0
+    for hunk in hunks:
+        old, new, top, bottom = _hunk_sides(hunk, reverse)
+        if reverse:
+            start, length = hunk.start_b, hunk.len_b
+        else:
+            start, length = hunk.start_a, hunk.len_a
+
+        # An insertion (with no old lines) goes after the line it names
+        if length:
+            start -= 1
+
+        result = None
+        tried = set()
+        for level in xrange(max(fuzz, 0) + 1):
+            # Try ignoring context at the top first, then at both ends
+            for trim_bottom in (False, True):
+                ftop = min(level, top)
+                fbottom = trim_bottom and min(level, bottom) or 0
+                if (ftop, fbottom) in tried:
+                    continue
+                tried.add((ftop, fbottom))
+
+                fold = old[ftop:len(old) - fbottom]
+                if fold:
+                    pos = _find(lines, fold, start + skew + ftop, cursor)
+                elif level:
+                    continue
+                else:
+                    pos = min(max(start + skew, cursor), len(lines))
+                if pos is None:
+                    continue
+
+                out.extend(lines[cursor:pos])
+                out.extend(new[ftop:len(new) - fbottom])
+                cursor = pos + len(fold)
+                skew = pos - ftop - start
+                result = HunkResult(hunk, pos - ftop + 1, skew,
+                                    max(ftop, fbottom))
+                break
+            if result is not None:
+                break
+
+        results.append(result or HunkResult(hunk))
+    out.extend(lines[cursor:])
+    return ''.join(out), results
+
+def _binary_varint(delta, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(delta):
+            raise BadBinaryDeltaError('delta was truncated')
+        byte = ord(delta[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+def apply_binary_delta(source, delta):
+    """Apply a GIT-format binary delta to the string `source' and return
+    the result; raises BadBinaryDeltaError if it doesn't fit."""
+    src_len, pos = _binary_varint(delta, 0)
+    dest_len, pos = _binary_varint(delta, pos)
+    if src_len != len(source):
+        raise BadBinaryDeltaError('delta is for a file of %d bytes, not %d'
+                                  % (src_len, len(source)))
+
+    out = []
+    size = len(delta)
+    while pos < size:
+        cmd = ord(delta[pos])
+        pos += 1
+        if cmd & 0x80:
+            # Copy from the source
+            offset = 0
+            length = 0
+            for bit in xrange(4):
+                if cmd & (1 << bit):
+                    if pos >= size:
+                        raise BadBinaryDeltaError('delta was truncated')
+                    offset |= ord(delta[pos]) << (8 * bit)
+                    pos += 1
+            for bit in xrange(3):
+                if cmd & (0x10 << bit):
+                    if pos >= size:
+                        raise BadBinaryDeltaError('delta was truncated')
+                    length |= ord(delta[pos]) << (8 * bit)
+                    pos += 1
+            if length == 0:
+                length = 0x10000
+            if offset + length > len(source):
+                raise BadBinaryDeltaError('copy from beyond the end of the '
+                                          'source')
+            out.append(source[offset:offset + length])
+        elif cmd:
+            # Copy bytes from the delta
+            if pos + cmd > size:
+                raise BadBinaryDeltaError('delta was truncated')
+            out.append(delta[pos:pos + cmd])
+            pos += cmd
+        else:
+            raise BadBinaryDeltaError('bad delta opcode')
+
+    result = ''.join(out)
+    if len(result) != dest_len:
+        raise BadBinaryDeltaError('delta produced %d bytes, not %d'
+                                  % (len(result), dest_len))
+    return result
+
+def _apply_binary(change, text, reverse):
+    """Return (<new text>, <error>) for a binary Change."""
+    for hunk in change.hunks:
+        if bool(hunk.reverse) == bool(reverse):
+            break
+    else:
+        return None, 'no %sbinary data' % (reverse and 'reverse ' or '')
+
+    if hunk.method == 'literal':
+        return hunk.data, None
+    try:
+        return apply_binary_delta(text or '', hunk.data), None
+    except BadBinaryDeltaError, e:
+        return None, 'binary patch does not apply: %s' % e.args[0]
+
+def _paths(change, reverse):
+    """Return the (source, dest) paths for applying `change', where None
+    means the file doesn't exist."""
+    source, dest = change.source, change.dest
+
+    # A git "new file mode" or "deleted file mode" line settles it.  Without
+    # one, only a /dev/null side (which the parser leaves as None) means the
+    # file is created or deleted: with -U0, an ordinary change at the top of
+    # a file has a hunk like "@@ -0,0 +1,2 @@" or "@@ -1,2 +0,0 @@" too, and
+    # the parser makes an Add or Delete of it
+    if isinstance(change, Add) and change.new_mode is not None:
+        source = None
+    elif isinstance(change, Delete) and change.old_mode is not None:
+        dest = None
+
+    if reverse:
+        return dest, source
+    return source, dest
+
+def apply_change(change, text, reverse=False, fuzz=DEFAULT_FUZZ):
+    """Apply a Change to `text', the contents of the file it changes (or
+    None if there is no such file); returns a ChangeResult.
+
+    reverse - if True, undo the Change instead
+    fuzz    - as for apply_hunks()"""
+    source, dest = _paths(change, reverse)
+    if reverse:
+        mode = getattr(change, 'old_mode', None)
+    else:
+        mode = getattr(change, 'new_mode', None)
+
+    result = ChangeResult(change, source, dest, mode=mode)
+    if source is None:
+        if text is not None:
+            result.error = 'file already exists'
+            return result
+        text = ''
+    elif text is None:
+        result.error = 'file not found'
+        return result
+
+    # When deleting a file, the hunks still have to apply, but needn't
+    # leave it empty
+    if not change.binary:
+        text, result.hunks = apply_hunks(text, [h for h in change.hunks
+                                                if not h.binary],
+                                         reverse, fuzz)
+    elif dest is not None:
+        text, result.error = _apply_binary(change, text, reverse)
+
+    if dest is not None:
+        result.text = text
+    return result
+
+def apply_changes(changes, files, reverse=False, fuzz=DEFAULT_FUZZ):
+    """Apply a list of Changes, as from diffparser.parse(), to `files', a
+    dictionary mapping paths to file contents.
+
+    Returns a tuple of a new dictionary with the patched contents (paths
+    that were deleted or renamed away are left out) and a list of
+    ChangeResults, one per Change.  `files' itself is not modified.
+
+    As with git, copies and renames take their text from `files', before
+    any other Change touches it.  If a Change fails, the file it was
+    applied to is left as it was.
+
+    reverse - if True, undo the Changes instead
+    fuzz    - as for apply_hunks()"""
+    result = dict(files)
+    results = []
+    for change in changes:
+        source, dest = _paths(change, reverse)
+        if source is None:
+            # Creating a file; apply_change() checks it doesn't exist
+            text = result.get(dest)
+        elif isinstance(change, (Copy, Rename)):
+            text = files.get(source)
+        else:
+            text = result.get(source)
+
+        outcome = apply_change(change, text, reverse, fuzz)
+        results.append(outcome)
+        if not outcome.ok:
+            continue
+
+        # Copying leaves the original where it was
+        if source is not None and source != dest \
+               and not (isinstance(change, Copy) and not reverse):
+            result.pop(source, None)
+        if dest is not None:
+            result[dest] = outcome.text
+    return result, results
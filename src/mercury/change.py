@@ -1,8 +1,23 @@
 import binascii, re
+import array
+import itertools
+import operator
 
 from mercury.utils import every, decode_delta
 
+# Rough per-object overheads (in bytes) used when estimating how much memory
+# a parsed diff occupies; these needn't be exact, just consistent.
+_OBJECT_OVERHEAD = 256
+_LINE_OVERHEAD = 17         # an op byte and two offsets
+
+def _mode_repr(mode):
+    if mode is None:
+        return 'None'
+    return '0%o' % mode
+
 class Change(object):
+    __slots__ = ['binary', 'hunks', 'source', 'dest', 'old_mode', 'new_mode',
+                 'similarity', 'dissimilarity']
     kind = 'change'
     
     def __init__(self, source=None, dest=None):
@@ -26,14 +41,24 @@ class Change(object):
         for h in self.hunks:
             result.append(str(h))
         return '\n'.join(result)
+
+    def _estimated_size(self):
+        """Return an estimate of the memory used by this Change."""
+        size = _OBJECT_OVERHEAD + len(self.source or '') + len(self.dest or '')
+        for h in self.hunks:
+            size += h._estimated_size()
+        return size
     
 class Rename(Change):
+    __slots__ = []
     kind = 'rename'
 
 class Copy(Change):
+    __slots__ = []
     kind = 'copy'
 
 class Delete(Change):
+    __slots__ = []
     kind = 'delete'
     
     def __init__(self, source, old_mode):
@@ -41,7 +66,8 @@ class Delete(Change):
         self.old_mode = old_mode
 
     def __repr__(self):
-        return 'Delete(source=%r, old_mode=0%o)' % (self.source, self.old_mode)
+        return 'Delete(source=%r, old_mode=%s)' % (self.source,
+                                                   _mode_repr(self.old_mode))
 
     def _unified_headers(self, extra_src='', extra_dest=''):
         src = self.source
@@ -50,6 +76,7 @@ class Delete(Change):
                                            dest, extra_dest)
 
 class Add(Change):
+    __slots__ = []
     kind = 'add'
     
     def __init__(self, dest, mode):
@@ -57,7 +84,7 @@ class Add(Change):
         self.new_mode = mode
 
     def __repr__(self):
-        return 'Add(dest=%r, mode=0%o)' % (self.source, self.new_mode)
+        return 'Add(dest=%r, mode=%s)' % (self.dest, _mode_repr(self.new_mode))
 
     def _unified_headers(self, extra_src='', extra_dest=''):
         src = '/dev/null'
@@ -66,23 +93,153 @@ class Add(Change):
                                            dest, extra_dest)
 
 class Hunk(object):
+    __slots__ = []
     binary = False
 
+class _HunkLines(object):
+    """A read-only sequence of (<op>, <text>) tuples, made on demand from a
+    TextHunk's compact line storage."""
+    __slots__ = ['_hunk']
+
+    def __init__(self, hunk):
+        self._hunk = hunk
+
+    def __len__(self):
+        return len(self._hunk._ops)
+
+    def __getitem__(self, ndx):
+        if isinstance(ndx, slice):
+            return [self[n] for n in xrange(*ndx.indices(len(self)))]
+        hunk = self._hunk
+        return (chr(hunk._ops[ndx]),
+                hunk._data[hunk._starts[ndx]:hunk._ends[ndx]])
+
+    def __iter__(self):
+        hunk = self._hunk
+        data = hunk._data
+        for op, start, end in itertools.izip(hunk._ops, hunk._starts,
+                                             hunk._ends):
+            yield (chr(op), data[start:end])
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return repr(list(self))
+
 class TextHunk(Hunk):
+    """A hunk of a unified diff.
+
+    Rather than a tuple per line, the lines are held as a bytearray of op
+    characters and tables of the offsets of each line's text in a string;
+    for hunks from diffparser, that is the text of the whole diff, shared
+    by all of its hunks.  `lines' makes the usual tuples on demand."""
+    __slots__ = ['start_a', 'len_a', 'start_b', 'len_b', '_data', '_ops',
+                 '_starts', '_ends', '_offset', '_end', '_fix_newline']
+
     def __init__(self, start_a, len_a, start_b, len_b):
         self.start_a = start_a
         self.len_a = len_a
         self.start_b = start_b
         self.len_b = len_b
-        self.lines = []
+        self._data = ''
+        self._ops = bytearray()
+        self._starts = array.array('L')
+        self._ends = array.array('L')
+
+        # For lazily parsed hunks, our part of the diff text
+        self._offset = self._end = 0
+        self._fix_newline = False
+
+    def _read(self, data, offset, size):
+        """Read this hunk's lines from the diff text `data', starting at
+        `offset'; returns the offset of the end of the hunk."""
+        from mercury.diffparser import _scan_hunk
+        self._data = data
+        return _scan_hunk(data, offset, size, self.len_a, self.len_b,
+                          self._ops, self._starts, self._ends)
+
+    def _defer(self, data, offset, end):
+        """Read the lines of this hunk from data[offset:end] on demand."""
+        self._data = data
+        self._ops = self._starts = self._ends = None
+        self._offset = offset
+        self._end = end
+
+    def _load(self):
+        self._ops = bytearray()
+        self._starts = array.array('L')
+        self._ends = array.array('L')
+        self._read(self._data, self._offset, len(self._data))
+        if self._fix_newline:
+            self._fix_newline = False
+            self.fix_final_newline()
+
+    @property
+    def lines(self):
+        """A read-only sequence of (<op>, <text>) tuples, one per line of
+        the hunk, where <op> is ' ', '-' or '+'.  It can't be changed in
+        place: hunk.lines.append(...) raises AttributeError, and assigning
+        to hunk.lines[i] raises TypeError.  To change the lines, assign a
+        new list to this property."""
+        if self._ops is None:
+            self._load()
+        return _HunkLines(self)
+
+    @lines.setter
+    def lines(self, lines):
+        ops = ''.join([op for op, text in lines])
+        if isinstance(ops, unicode):
+            ops = ops.encode('ascii')
+        self._ops = bytearray(ops)
+        self._starts = array.array('L')
+        self._ends = array.array('L')
+        pos = 0
+        for op, text in lines:
+            self._starts.append(pos)
+            pos += len(text)
+            self._ends.append(pos)
+        self._data = ''.join([text for op, text in lines])
+        self._fix_newline = False
 
     def fix_final_newline(self):
-        l = self.lines[-1]
-        if l[1].endswith('\r\n'):
-            nl = l[1][:-2]
-        else:
-            nl = l[1][:-1]
-        self.lines[-1] = (l[0], nl)
+        if self._ops is None:
+            if self._end > self._offset:
+                self._fix_newline = True
+                return
+            self._load()
+        if not self._ops:
+            return
+
+        start, end = self._starts[-1], self._ends[-1]
+        if end - start >= 2 and self._data[end-2:end] == '\r\n':
+            end -= 2
+        elif end > start:
+            end -= 1
+        self._ends[-1] = end
+
+    def _estimated_size(self):
+        if self._ops is None:
+            # Charge a lazy hunk what it will occupy once its lines are read,
+            # since whoever is holding it won't be told when that happens.
+            # There is at most one line per newline and a final unterminated
+            # one, plus padding if the diff was cut off part way through.
+            lines = self._data.count('\n', self._offset, self._end) + 1
+            if self._end >= len(self._data):
+                lines += max(self.len_a, self.len_b, 0)
+            return _OBJECT_OVERHEAD + _LINE_OVERHEAD * lines \
+                   + self._end - self._offset
+        return _OBJECT_OVERHEAD + _LINE_OVERHEAD * len(self._ops) \
+               + sum(itertools.imap(operator.sub, self._ends, self._starts))
 
     def __repr__(self):
         return 'TextHunk(%r, %r, %r, %r)' % (self.start_a,
@@ -100,6 +257,7 @@ class TextHunk(Hunk):
 
 _NOT_PRINTABLE = re.compile(r'[^ -~]')
 class BinaryHunk(Hunk):
+    __slots__ = ['length', 'method', 'data', 'reverse']
     binary = True
     
     def __init__(self, length, method, data=None, reverse=False):
@@ -108,6 +266,9 @@ class BinaryHunk(Hunk):
         self.data = data
         self.reverse = reverse
 
+    def _estimated_size(self):
+        return _OBJECT_OVERHEAD + len(self.data or '')
+
     def __str__(self):
         reverse = ''
         if self.reverse:
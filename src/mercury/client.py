@@ -182,7 +182,8 @@ class Client(object):
     """A client of the Mercurial server process.  Do not use this directly;
     instead, use a Repository object."""
 
-    def __init__(self, path=None, encoding='utf-8', configs=None, hg=None):
+    def __init__(self, path=None, encoding='utf-8', configs=None, hg=None,
+                 cwd=None):
         if not hg:
             for searchpath in os.environ['PATH'].split(os.pathsep):
                 possible_hg = os.path.join(searchpath, 'hg')
@@ -199,6 +200,9 @@ class Client(object):
             raise NotARepositoryError('%s is not a valid Mercurial repository'
                                       % path)
 
+        self._hg = hg
+        self._configs = configs
+        self._cwd = cwd
         self._args = [hg, 'serve', '--cmdserver', 'pipe',
                       '--config', 'ui.interactive=True',
                       '--config', 'extensions.hglist=',
@@ -221,6 +225,16 @@ class Client(object):
     def __exit(self, exc_type, exc_val, exc_tb):
         self.disconnect()
 
+    def copy(self, cwd=None):
+        """Return a new, unconnected Client for the same repository and
+        with the same settings as this one.  If `cwd' is given, the new
+        server will run in that directory, which affects how hg displays
+        relative paths."""
+        client = Client(self._path, self._default_encoding,
+                        self._configs, self._hg, cwd or self._cwd)
+        client.debug = self.debug
+        return client
+
     def connect(self):
         """Spawns a new Mercurial server instance"""
         if self._server is not None:
@@ -233,6 +247,7 @@ class Client(object):
                                         stdin=subprocess.PIPE,
                                         stdout=subprocess.PIPE,
                                         stderr=subprocess.PIPE,
+                                        cwd=self._cwd,
                                         env=env)
 
         self._read_hello()
@@ -472,6 +487,63 @@ class Client(object):
                                 use_server=use_server,
                                 binary=binary)
 
+    def stream_execute(self, cmd_name, *args, **kwargs):
+        """Execute a command after building its arguments, yielding its
+        (binary) output in chunks as the server sends it.
+
+        Because the return code only arrives once the command has finished,
+        errors are reported after all of the output has been yielded; if an
+        error handler `eh' is given, it is called (with an empty output
+        argument) and its result is ignored, otherwise we raise CommandError.
+
+        If you stop iterating early, the rest of the output is read and
+        discarded so that the server is ready for the next command."""
+        eh = kwargs.pop('eh', None)
+        args = [cmd_name] + self.build_args(*args, **kwargs)
+
+        if self.debug:
+            print 'sending: %r' % args
+
+        if not self._server:
+            self.connect()
+
+        self._server.stdin.write('runcommand\n')
+        self._write('\0'.join(args))
+
+        err = cStringIO.StringIO()
+        ret = None
+        try:
+            while True:
+                channel, data = self._read()
+
+                if channel == 'o':
+                    yield data
+                elif channel == 'e':
+                    err.write(data)
+                elif channel == 'r':
+                    ret = struct.unpack('>i', data)[0]
+                    break
+                elif channel.isupper():
+                    raise ChannelError('unexpected data on required channel "%s"'
+                                       % channel)
+        finally:
+            # Drain anything left over so the server can accept a new command
+            while ret is None:
+                channel, data = self._read()
+                if channel in 'IL':
+                    self._write('')
+                elif channel == 'r':
+                    ret = struct.unpack('>i', data)[0]
+
+        if ret:
+            err = err.getvalue().decode(self._encoding)
+            if self.debug:
+                print 'failed with error: %r' % err
+
+            if eh is None:
+                raise CommandError(args, ret, '', err)
+            eh(args, ret, '', err)
+
     def get_file(self, name, mode, revision):
         """Spawns a new hg instance to obtain the content of the specified
         file at the specified revision.  Returns a file object."""
@@ -0,0 +1,93 @@
+import datetime
+
+class SimpleTzInfo(datetime.tzinfo):
+    """A fixed offset from UTC, specified in minutes east of UTC.
+
+    Don't create these directly; use tzinfo(), which shares them."""
+    __slots__ = ['_offset', '_delta']
+
+    def __init__(self, offset):
+        self._offset = offset
+        self._delta = datetime.timedelta(minutes=offset)
+
+    def __repr__(self):
+        return 'SimpleTzInfo(%r)' % self._offset
+
+    def __reduce__(self):
+        return (tzinfo, (self._offset,))
+
+    def utcoffset(self, dt):
+        return self._delta
+
+    def dst(self, dt):
+        return _ZERO
+
+    def tzname(self, dt):
+        if self._offset >= 0:
+            return '+%02d%02d' % divmod(self._offset, 60)
+        else:
+            return '-%02d%02d' % divmod(-self._offset, 60)
+
+_ZERO = datetime.timedelta(0)
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_tzinfos = {}
+
+def tzinfo(offset):
+    """Return a SimpleTzInfo for the given offset in minutes east of UTC.
+    The same object is returned every time for a given offset."""
+    tz = _tzinfos.get(offset)
+    if tz is None:
+        tz = _tzinfos[offset] = SimpleTzInfo(offset)
+    return tz
+
+def from_timestamp(ts, offset=0):
+    """Convert a UNIX timestamp to a datetime in the time zone `offset'
+    minutes east of UTC."""
+    return (_EPOCH + datetime.timedelta(seconds=ts, minutes=offset)) \
+           .replace(tzinfo=tzinfo(offset))
+
+# Repeated dates are very common (every line from a given changeset in an
+# annotate, every match in a given revision in a grep...), so we memoize the
+# conversions.  The memo is simply dropped when it gets too big.
+_MEMO_SIZE = 8192
+_memo = {}
+
+def _remember(key, value):
+    if len(_memo) >= _MEMO_SIZE:
+        _memo.clear()
+    _memo[key] = value
+    return value
+
+def from_hgdate(hgdate):
+    """Convert a date in Mercurial's `hgdate' form, i.e. a UNIX timestamp
+    and an offset in seconds *west* of UTC separated by a space, to a
+    datetime in the original time zone."""
+    result = _memo.get(hgdate)
+    if result is None:
+        ts, offset = hgdate.split(' ', 1)
+        result = _remember(hgdate, from_timestamp(float(ts),
+                                                  -int(offset) // 60))
+    return result
+
+_MONTHS = { 'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+            'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12 }
+
+def from_datestr(datestr):
+    """Convert a date as displayed by Mercurial, e.g.
+
+      Sat Jan 24 01:33:20 1970 -0200
+
+    to a datetime in the original time zone."""
+    result = _memo.get(datestr)
+    if result is None:
+        weekday, month, day, time, year, offset = datestr.split()
+        hour, minute, second = time.split(':')
+        ofs = int(offset[-4:-2]) * 60 + int(offset[-2:])
+        if offset.startswith('-'):
+            ofs = -ofs
+        result = _remember(datestr,
+                           datetime.datetime(int(year), _MONTHS[month],
+                                             int(day), int(hour), int(minute),
+                                             int(second), 0, tzinfo(ofs)))
+    return result
@@ -1,5 +1,4 @@
 import re
-import cStringIO as StringIO
 import zlib
 
 from mercury.change import *
@@ -152,6 +151,10 @@ def _find_name(s, defname, encoding, with_date=False):
                 name = s[:ndx]
             else:
                 name = s
+
+    # /dev/null stands for a file that doesn't exist
+    if name.rstrip() == '/dev/null':
+        return None
         
     name = name.strip(' \t').split('/', 1)
 
@@ -260,6 +263,12 @@ _git_handlers = (
 #     _handle_index),
 )
 
+# The same handlers, keyed by the first character of the lines they match
+_git_handlers_by_char = {}
+for _rx, _handler in _git_handlers:
+    _git_handlers_by_char.setdefault(_rx.pattern[0], []).append((_rx, _handler))
+del _rx, _handler
+
 _DIFF_RE = re.compile(r'diff\s+')
 _UNIFIED_1_RE = re.compile(r'---\s+')
 _UNIFIED_2_RE = re.compile(r'\+\+\+\s+')
@@ -270,30 +279,29 @@ _BINARY_RE = re.compile(r'GIT\s+binary\s+patch')
 _UNIFIED_HUNK_RE = re.compile(r'@@\s+-(\d+)(?:,(\d+))?\s+\+(\d+)(?:,(\d+))?\s+@@')
 _CONTEXT_HUNK_RE = re.compile(r'(?:---|\*\*\*)\s+(\d+)(?:,(\d+))?\s+(?:---|\*\*\*)')
 
-class Linebuffer(object):
-    def __init__(self, file_or_str):
-        if isinstance(file_or_str, basestring):
-            self.f = StringIO.StringIO(file_or_str)
-        else:
-            self.f = file_or_str
-        self.buffered = []
-        
-    def __iter__(self):
-        return self
-    
-    def next(self):
-        if self.buffered:
-            return self.buffered.pop(0)
-        return self.f.next()
+class _Reader(object):
+    """Reads lines from a string by offset, without copying anything but
+    the lines asked for.  push() can only give back the line that was just
+    read, which is all the parser needs."""
+    __slots__ = ['data', 'pos', 'size']
 
-    def push(self, line):
-        self.buffered.append(line)
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.size = len(data)
 
     def readline(self):
-        try:
-            return self.next()
-        except StopIteration:
-            return ''
+        pos = self.pos
+        end = self.data.find('\n', pos)
+        if end < 0:
+            end = self.size
+        else:
+            end += 1
+        self.pos = end
+        return self.data[pos:end]
+
+    def push(self, line):
+        self.pos -= len(line)
 
 def _parse_unified_header(line):
     m = _UNIFIED_HUNK_RE.match(line)
@@ -325,35 +333,135 @@ def _parse_context_header(line):
 
     return s, l
 
-def _parse_unified(change, line, source, encoding):
+def _scan_hunk(data, pos, size, la, lb, ops, starts, ends):
+    """Read the lines of the unified diff hunk at offset `pos' in `data',
+    which has `la' lines on the old side and `lb' on the new, appending the
+    op character of each to the bytearray `ops' and the offsets of its text
+    to the arrays `starts' and `ends'.  Returns the offset of the end of
+    the hunk."""
+    # This is the innermost loop, so we work directly on the buffer and
+    # don't copy any text at all
+    find = data.find
+    add_op = ops.append
+    add_start = starts.append
+    add_end = ends.append
+    while la or lb:
+        if pos >= size:
+            # A truncated hunk; pad it out with empty lines
+            for n in xrange(max(la, lb, 0)):
+                add_op(32)
+                add_start(0)
+                add_end(0)
+            break
+
+        end = find('\n', pos)
+        if end < 0:
+            end = size
+        else:
+            end += 1
+
+        op = data[pos]
+        if op == ' ':
+            add_op(32)
+            la -= 1
+            lb -= 1
+        elif op == '-':
+            add_op(45)
+            la -= 1
+        elif op == '+':
+            add_op(43)
+            lb -= 1
+        elif op == '\n' or (op == '\r' and end - pos == 2
+                            and data[pos+1] == '\n'):
+            # Blank lines count as context, and keep their line ending
+            add_op(32)
+            add_start(pos)
+            add_end(end)
+            la -= 1
+            lb -= 1
+            pos = end
+            continue
+        else:
+            add_op(ord(op))
+        add_start(pos + 1)
+        add_end(end)
+        pos = end
+    return pos
+
+def _skip_hunk(data, pos, size, la, lb):
+    """Return the offset of the end of the hunk at `pos', as _scan_hunk()
+    would, but without reading its lines."""
+    find = data.find
+    while (la or lb) and pos < size:
+        end = find('\n', pos)
+        if end < 0:
+            end = size
+        else:
+            end += 1
+
+        op = data[pos]
+        if op == ' ':
+            la -= 1
+            lb -= 1
+        elif op == '-':
+            la -= 1
+        elif op == '+':
+            lb -= 1
+        elif op == '\n' or (op == '\r' and end - pos == 2
+                            and data[pos+1] == '\n'):
+            la -= 1
+            lb -= 1
+        pos = end
+    return pos
+
+def _fix_final_newline(lines):
+    """Remove the line ending from the last of `lines', a list of (<op>,
+    <text>) tuples, as a "\\ No newline at end of file" line says to."""
+    if not lines:
+        return
+    op, text = lines[-1]
+    if text.endswith('\r\n'):
+        text = text[:-2]
+    elif text.endswith('\n'):
+        text = text[:-1]
+    lines[-1] = (op, text)
+
+def _as_add(change):
+    """Turn `change' into an Add, keeping its source path.  Without a git
+    "new file mode" line, an empty old side may just mean the hunk comes
+    before the first line, so the Add has no mode; the source is None only
+    if the diff said /dev/null."""
+    add = Add(change.dest, None)
+    add.source = change.source
+    return add
+
+def _as_delete(change):
+    """Turn `change' into a Delete, keeping its dest path; see _as_add()."""
+    delete = Delete(change.source, None)
+    delete.dest = change.dest
+    return delete
+
+def _parse_unified(change, line, source, encoding, lazy=False):
     """Parse a unified diff, adding it to the specified Change; returns
-    the Change object."""
+    the Change object.  If `lazy' is True, the hunk's lines are only read
+    from the diff when they are first used."""
     sa, la, sb, lb = _parse_unified_header(line)
 
     # With non-git-format, it's possible that we won't detect an add or
     # delete until this point.  Handle it here by creating a new Change
     # object.
     if sa == 0 and la == 0 and not isinstance(change, Add):
-        change = Add(change.dest, None)
+        change = _as_add(change)
     elif sb == 0 and lb == 0 and not isinstance(change, Delete):
-        change = Delete(change.source, None)
+        change = _as_delete(change)
                 
     hunk = TextHunk(sa, la, sb, lb)
-    while la or lb:
-        hline = source.readline()
-        if not hline or hline in ['\n', '\r\n']:
-            hunk.lines.append((' ', hline))
-            la -= 1
-            lb -= 1
-            continue
-
-        hl = (hline[0], hline[1:])
-
-        hunk.lines.append(hl)
-        if hl[0] in ' -':
-            la -= 1
-        if hl[0] in ' +':
-            lb -= 1
+    if lazy:
+        end = _skip_hunk(source.data, source.pos, source.size, la, lb)
+        hunk._defer(source.data, source.pos, end)
+        source.pos = end
+    else:
+        source.pos = hunk._read(source.data, source.pos, source.size)
 
     # Check for \ No newline at end of file
     hline = source.readline()
@@ -366,77 +474,80 @@ def _parse_unified(change, line, source, encoding):
     
     return change
 
-def _parse_context(change, line, source, encoding):
-    """Parse a context diff, adding it to the specified Change; returns
-    the Change object."""
-    # Parse the first part
-    sa, la = _parse_context_header(line)
-
-    # With non-git-format, it's possible that we won't detect an add or
-    # delete until this point.  Handle it here by creating a new Change
-    # object.
-    if sa == 0 and la == 0 and not isinstance(change, Add):
-        change = Add(change.dest, None)
-
-    hunk = TextHunk(sa, la, 0, 0)
-    while la:
+def _read_context_lines(source, ops):
+    """Read the lines of one side of a context diff hunk, as (<op>, <text>)
+    tuples, where <op> is ' ' or the op character in `ops'."""
+    lines = []
+    while True:
         hline = source.readline()
-        if not hline:
-            break
-        if hline.startswith('---'):
+        if hline.startswith(r'\ '):
+            _fix_final_newline(lines)
+            continue
+        if len(hline) < 2 or hline[1] != ' ' or hline[0] not in ops:
             source.push(hline)
-            break
+            return lines
+        lines.append((hline[0], hline[2:]))
+
+def _merge_context(old, new):
+    """Merge the two sides of a context diff hunk into one list of
+    (<op>, <text>) tuples, as for a unified diff."""
+    # A side with nothing but context is left out of the diff
+    if not old:
+        old = [l for l in new if l[0] == ' ']
+    if not new:
+        new = [l for l in old if l[0] == ' ']
+
+    lines = []
+    a = b = 0
+    while a < len(old) or b < len(new):
+        if a < len(old) and old[a][0] != ' ':
+            # Removed lines, including the old half of a change ('!')
+            while a < len(old) and old[a][0] != ' ':
+                lines.append(('-', old[a][1]))
+                a += 1
+            if b < len(new) and new[b][0] == '!':
+                while b < len(new) and new[b][0] == '!':
+                    lines.append(('+', new[b][1]))
+                    b += 1
+        elif b < len(new) and new[b][0] != ' ':
+            lines.append(('+', new[b][1]))
+            b += 1
+        else:
+            if a < len(old):
+                lines.append((' ', old[a][1]))
+            else:
+                lines.append((' ', new[b][1]))
+            a += 1
+            b += 1
+    return lines
 
-        if hline.startswith('! ') or hline.startswith('- '):
-            hunk.lines.append(('-', hline[2:]))
-        elif hline.startswith('  '):
-            hunk.lines.append((' ', hline[2:]))
+def _parse_context(change, line, source, encoding):
+    """Parse a context diff, adding it to the specified Change; returns
+    the Change object.  `line' is the row of asterisks that starts the
+    hunk; the ranges and the lines of each side follow it."""
+    sa, ea = _parse_context_header(source.readline())
+    old = _read_context_lines(source, ' -!')
 
-    # Check for \ No newline at end of file
     hline = source.readline()
-    if hline.startswith(r'\ '):
-        hunk.fix_final_newline()
-    else:
+    if not hline.startswith('---'):
         source.push(hline)
+    sb, eb = _parse_context_header(hline)
+    new = _read_context_lines(source, ' +!')
 
-    # Parse the second part
-    sb, lb = _parse_context_header(line)
-
-    # Only for non-git format
-    if sb == 0 and lb == 0 and not isinstance(change, Delete):
-        change = Delete(change.source, None)
-
-    ndx = 1
-    while lb:
-        hline = source.readline()
-        if not hline:
-            break
-
-        if hline.startswith('! ') or hline.startswith('+ '):
-            n = ('+', hline[2:])
-        elif hline.startswith('  '):
-            n = (' ', hline[2:])
-
-        while True:
-            if ndx >= len(hunk.lines):
-                h = (' ', '')
-            else:
-                h = hunk.lines[ndx]
-            ndx += 1
-            if h == n:
-                break
-            elif h[0] == '-':
-                continue
-            else:
-                hunk.lines.insert(ndx - 1, n)
+    lines = _merge_context(old, new)
+    la = len([l for l in lines if l[0] != '+'])
+    lb = len([l for l in lines if l[0] != '-'])
 
-    # Check for \ No newline at end of file
-    hline = source.readline()
-    if hline.startswith(r'\ '):
-        hunk.fix_final_newline()
-    else:
-        source.push(hline)
+    # With non-git-format, it's possible that we won't detect an add or
+    # delete until this point.  Handle it here by creating a new Change
+    # object.
+    if sa == 0 and la == 0 and not isinstance(change, Add):
+        change = _as_add(change)
+    elif sb == 0 and lb == 0 and not isinstance(change, Delete):
+        change = _as_delete(change)
 
+    hunk = TextHunk(sa, la, sb, lb)
+    hunk.lines = lines
     change.hunks.append(hunk)
 
     return change
@@ -509,35 +620,54 @@ def _parse_binary(change, source, encoding, default_filename):
     change.binary = True
     return change
     
-def parse(file_or_str, encoding='utf-8'):
+def parse(file_or_str, encoding='utf-8', lazy=False):
     """Parse a set of patches in diff format, yielding Change objects
-    describing each of the changes therein."""
-    
-    source = Linebuffer(file_or_str)
+    describing each of the changes therein.
+
+    If `lazy' is True, the lines of unified diff hunks are not split up
+    until something looks at them; until then, each TextHunk just refers
+    to its part of the diff text.  This makes it much cheaper to parse a
+    large diff if you only want the names of the files it touches, or the
+    hunk headers."""
+    if isinstance(file_or_str, basestring):
+        data = file_or_str
+    elif hasattr(file_or_str, 'read'):
+        data = file_or_str.read()
+    else:
+        data = ''.join(file_or_str)
+
+    source = _Reader(data)
     default_filename = None
     change = None
     scanning_git = False
     mode = None
-    
-    for line in source:
-        if _DIFF_RE.match(line):
+
+    # Most lines are consumed by _parse_unified(); the rest are dispatched
+    # on their first character, so that we only try the patterns that
+    # could possibly match
+    while True:
+        line = source.readline()
+        if not line:
+            break
+
+        first = line[0]
+        if first == 'd' and _DIFF_RE.match(line):
             if change:
                 yield change
 
             scanning_git = bool(_GIT_RE.match(line))
             default_filename = extract_filename(line.rstrip(' \t\r\n'))
             change = Change()
-        elif _UNIFIED_1_RE.match(line):
+        elif first == '-' and _UNIFIED_1_RE.match(line):
             next = source.readline()
             if not _UNIFIED_2_RE.match(next):
-                
                 source.push(next)
                 continue
             change = _handle_unified(line, next, change, default_filename,
                                      encoding)
             mode = 'unified'
             scanning_git = False
-        elif _CONTEXT_1_RE.match(line):
+        elif first == '*' and _CONTEXT_1_RE.match(line):
             next = source.readline()
             if not _CONTEXT_2_RE.match(next):
                 source.push(next)
@@ -546,20 +676,23 @@ def parse(file_or_str, encoding='utf-8'):
                                      encoding)
             mode = 'context'
             scanning_git = False
-        elif _BINARY_RE.match(line):
+        elif first == 'G' and _BINARY_RE.match(line):
             change = _parse_binary(change, source, encoding, default_filename)
-        elif mode == 'unified' and line.startswith('@'):
-            change = _parse_unified(change, line, source, encoding)
-        elif mode == 'context' and line.startswith('***************'):
+        elif first == '@' and mode == 'unified':
+            change = _parse_unified(change, line, source, encoding, lazy)
+        elif first == '*' and mode == 'context' \
+                 and line.startswith('***************'):
             change = _parse_context(change, line, source, encoding)
         elif scanning_git:
-            sline = line.rstrip(' \t\r\n')
-            for rx, handler in _git_handlers:
-                m = rx.match(sline)
-                if m:
-                    change = handler(sline, m, change, default_filename,
-                                     encoding)
-                    break
+            handlers = _git_handlers_by_char.get(first)
+            if handlers:
+                sline = line.rstrip(' \t\r\n')
+                for rx, handler in handlers:
+                    m = rx.match(sline)
+                    if m:
+                        change = handler(sline, m, change, default_filename,
+                                         encoding)
+                        break
 
     if change:
         yield change
@@ -48,3 +48,6 @@ class NotARepositoryError(MercuryException):
 
 class BadBinaryDeltaError(MercuryException):
     pass
+
+class WatcherError(MercuryException):
+    pass
@@ -0,0 +1,442 @@
+"""Local evaluation of revset trees.
+
+A Graph holds the parent links and a little metadata (branch, author,
+date and phase) for every changeset in a repository, which is enough to
+answer many of the revsets that Querysets generate without asking hg.
+Parts of a tree that need anything else are rendered back into revsets
+and handed to the server, so a mixed query costs at most one round trip
+per server-only subtree."""
+
+import re
+import time
+import bisect
+
+from mercury import revset
+
+class Unsupported(Exception):
+    """Raised internally when a tree can't be evaluated locally."""
+    pass
+
+_ISO_RE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d))?)?$')
+
+def _date_bounds(datestr):
+    """Return the earliest and latest UNIX timestamps matched by an ISO
+    8601 date string, interpreted (as hg does) in local time."""
+    m = _ISO_RE.match(datestr.strip())
+    if not m:
+        raise Unsupported()
+    year, month, day, hour, minute, second = m.groups()
+    date = (int(year), int(month), int(day))
+    if hour is None:
+        lo = date + (0, 0, 0)
+        hi = date + (23, 59, 59)
+    elif second is None:
+        lo = date + (int(hour), int(minute), 0)
+        hi = date + (int(hour), int(minute), 59)
+    else:
+        lo = hi = date + (int(hour), int(minute), int(second))
+    return (time.mktime(lo + (0, 0, -1)), time.mktime(hi + (0, 0, -1)))
+
+def _string_matcher(value, casesensitive=True):
+    """Return a function that matches strings as hg does for the string
+    argument `value' to branch(), user() and so on."""
+    if value.startswith('re:'):
+        flags = 0
+        if not casesensitive:
+            flags = re.I
+        return re.compile(value[3:], flags).search
+    if value.startswith('literal:'):
+        value = value[8:]
+    if casesensitive:
+        return lambda s: s == value
+    value = value.lower()
+    return lambda s: value in s.lower()
+
+def _unquote(tree, encoding):
+    """Return the contents of a ('string', ...) node as unicode, like the
+    metadata in a Graph, decoding it from `encoding'."""
+    if tree[0] != 'string':
+        raise Unsupported()
+    text = tree[1][1:-1]
+    if isinstance(text, unicode):
+        return text
+    if '\\' in text:
+        text = text.decode('string_escape')
+    try:
+        return text.decode(encoding)
+    except UnicodeDecodeError:
+        raise Unsupported()
+
+class Graph(object):
+    """The parent graph and basic metadata of a repository.
+
+    `infos' is a sequence of (rev, node, p1rev, p2rev, branch, author,
+    timestamp, phase) tuples in revision order; `encoding' is the one
+    string arguments in revsets are in."""
+
+    def __init__(self, infos, encoding='utf-8'):
+        self.encoding = encoding
+        self.revs = []
+        self.nodes = {}
+        self.parents = {}
+        self.branches = {}
+        self.authors = {}
+        self.dates = {}
+        self.phases = {}
+        self.branch_names = set()
+        self._children = None
+        self._revset = None
+        for rev, node, p1, p2, branch, author, date, phase in infos:
+            self.revs.append(rev)
+            self.nodes[rev] = node
+            self.parents[rev] = tuple([p for p in (p1, p2) if p >= 0])
+            self.branches[rev] = branch
+            self.authors[rev] = author
+            self.dates[rev] = date
+            self.phases[rev] = phase
+            self.branch_names.add(branch)
+
+    @property
+    def revset(self):
+        if self._revset is None:
+            self._revset = frozenset(self.revs)
+        return self._revset
+
+    @property
+    def children(self):
+        if self._children is None:
+            children = dict([(rev, []) for rev in self.revs])
+            for rev in self.revs:
+                for p in self.parents[rev]:
+                    children[p].append(rev)
+            self._children = children
+        return self._children
+
+    def evaluate(self, tree, remote):
+        """Return the revision numbers selected by `tree', in order.  Any
+        subtree that can't be answered locally is rendered and passed to
+        `remote', which must return a list of revision numbers."""
+        return self._eval(tree, remote)
+
+    # Evaluation; each of these returns a list of revisions in order
+
+    def _eval(self, tree, remote):
+        op = tree[0]
+        method = getattr(self, '_eval_' + op, None)
+        if method is not None:
+            try:
+                return method(tree, remote)
+            except Unsupported:
+                pass
+        # We can't do this locally, but maybe hg can evaluate it (and its
+        # parent can be done locally)
+        return remote(revset.render(tree))
+
+    def _eval_all(self, tree, remote):
+        return list(self.revs)
+
+    def _eval_none(self, tree, remote):
+        return []
+
+    def _eval_symbol(self, tree, remote):
+        if tree[1] == 'tip':
+            return self.revs[-1:]
+        elif not tree[1].isdigit():
+            raise Unsupported()
+        return self._func_rev((tree,), remote)
+
+    def _eval_and(self, tree, remote):
+        result = self._eval(tree[1], remote)
+        for term in tree[2:]:
+            if not result:
+                break
+            other = set(self._eval(term, remote))
+            result = [rev for rev in result if rev in other]
+        return result
+
+    def _eval_or(self, tree, remote):
+        # hg keeps the order of the operands, not the revisions
+        seen = set()
+        result = []
+        for term in tree[1:]:
+            for rev in self._eval(term, remote):
+                if rev not in seen:
+                    seen.add(rev)
+                    result.append(rev)
+        return result
+
+    def _eval_not(self, tree, remote):
+        exclude = set(self._eval(tree[1], remote))
+        return [rev for rev in self.revs if rev not in exclude]
+
+    def _eval_minus(self, tree, remote):
+        exclude = set(self._eval(tree[2], remote))
+        return [rev for rev in self._eval(tree[1], remote)
+                if rev not in exclude]
+
+    def _endpoint(self, tree):
+        if tree[0] == 'symbol' and tree[1].lstrip('-').isdigit():
+            rev = int(tree[1])
+            if rev < 0:
+                rev += len(self.revs)
+            return rev
+        raise Unsupported()
+
+    def _eval_range(self, tree, remote):
+        if not self.revs:
+            return []
+        start = end = None
+        if tree[1] is not None:
+            start = self._endpoint(tree[1])
+        else:
+            start = self.revs[0]
+        if tree[2] is not None:
+            end = self._endpoint(tree[2])
+        else:
+            end = self.revs[-1]
+        lo = bisect.bisect_left(self.revs, min(start, end))
+        hi = bisect.bisect_right(self.revs, max(start, end))
+        result = self.revs[lo:hi]
+        if start > end:
+            result.reverse()
+        return result
+
+    def _eval_dagrange(self, tree, remote):
+        if tree[1] is None and tree[2] is None:
+            return list(self.revs)
+        result = None
+        if tree[1] is not None:
+            result = set(self._descendants(self._eval(tree[1], remote)))
+        if tree[2] is not None:
+            ancestors = set(self._ancestors(self._eval(tree[2], remote)))
+            if result is None:
+                result = ancestors
+            else:
+                result &= ancestors
+        return sorted(result)
+
+    def _eval_parent(self, tree, remote):
+        revs = self._eval(tree[1], remote)
+        if tree[2] == 0:
+            return revs
+        result = set()
+        for rev in revs:
+            parents = self.parents[rev]
+            if len(parents) >= tree[2]:
+                result.add(parents[tree[2] - 1])
+        return sorted(result)
+
+    def _eval_func(self, tree, remote):
+        method = getattr(self, '_func_' + tree[1].lstrip('_'), None)
+        if method is None:
+            raise Unsupported()
+        return method(tree[2:], remote)
+
+    def _ancestors(self, revs):
+        seen = set(revs)
+        todo = list(seen)
+        while todo:
+            for p in self.parents[todo.pop()]:
+                if p not in seen:
+                    seen.add(p)
+                    todo.append(p)
+        return seen
+
+    def _descendants(self, revs):
+        if not revs:
+            return set()
+        # Children always have higher revision numbers than their parents,
+        # so a single pass upwards from the lowest finds them all
+        seen = set(revs)
+        start = bisect.bisect_left(self.revs, min(seen))
+        for rev in self.revs[start:]:
+            if rev not in seen:
+                for p in self.parents[rev]:
+                    if p in seen:
+                        seen.add(rev)
+                        break
+        return seen
+
+    def _one_arg(self, args, remote):
+        if len(args) != 1:
+            raise Unsupported()
+        return self._eval(args[0], remote)
+
+    def _int_arg(self, args, ndx, default):
+        if len(args) <= ndx:
+            return default
+        if args[ndx][0] != 'symbol' or not args[ndx][1].isdigit():
+            raise Unsupported()
+        return int(args[ndx][1])
+
+    # Graph functions
+
+    def _func_ancestors(self, args, remote):
+        return sorted(self._ancestors(self._one_arg(args, remote)))
+
+    def _func_descendants(self, args, remote):
+        return sorted(self._descendants(self._one_arg(args, remote)))
+
+    def _func_parents(self, args, remote):
+        result = set()
+        for rev in self._one_arg(args, remote):
+            result.update(self.parents[rev])
+        return sorted(result)
+
+    def _func_p1(self, args, remote):
+        if len(args) != 1:
+            raise Unsupported()
+        return self._eval_parent(('parent', args[0], 1), remote)
+
+    def _func_p2(self, args, remote):
+        if len(args) != 1:
+            raise Unsupported()
+        return self._eval_parent(('parent', args[0], 2), remote)
+
+    def _func_children(self, args, remote):
+        children = self.children
+        result = set()
+        for rev in self._one_arg(args, remote):
+            result.update(children[rev])
+        return sorted(result)
+
+    def _func_heads(self, args, remote):
+        revs = self._one_arg(args, remote)
+        members = set(revs)
+        children = self.children
+        return sorted([rev for rev in members
+                       if not [c for c in children[rev] if c in members]])
+
+    def _func_roots(self, args, remote):
+        revs = self._one_arg(args, remote)
+        members = set(revs)
+        return sorted([rev for rev in members
+                       if not [p for p in self.parents[rev] if p in members]])
+
+    def _func_max(self, args, remote):
+        revs = self._one_arg(args, remote)
+        return revs and [max(revs)] or []
+
+    def _func_min(self, args, remote):
+        revs = self._one_arg(args, remote)
+        return revs and [min(revs)] or []
+
+    def _func_reverse(self, args, remote):
+        revs = self._one_arg(args, remote)
+        revs.reverse()
+        return revs
+
+    def _func_first(self, args, remote):
+        if not 1 <= len(args) <= 2:
+            raise Unsupported()
+        return self._eval(args[0], remote)[:self._int_arg(args, 1, 1)]
+
+    def _func_last(self, args, remote):
+        if not 1 <= len(args) <= 2:
+            raise Unsupported()
+        count = self._int_arg(args, 1, 1)
+        if not count:
+            return []
+        return self._eval(args[0], remote)[-count:]
+
+    def _func_limit(self, args, remote):
+        if not 1 <= len(args) <= 3:
+            raise Unsupported()
+        count = self._int_arg(args, 1, 1)
+        offset = self._int_arg(args, 2, 0)
+        return self._eval(args[0], remote)[offset:offset+count]
+
+    def _func_intlist(self, args, remote):
+        if len(args) != 1:
+            raise Unsupported()
+        text = _unquote(args[0], self.encoding)
+        members = self.revset
+        return [int(rev) for rev in text.split(u'\x00')
+                if rev and int(rev) in members]
+
+    # Single revisions
+
+    def _func_rev(self, args, remote):
+        rev = self._int_arg(args, 0, None)
+        if rev in self.revset:
+            return [rev]
+        return []
+
+    def _func_id(self, args, remote):
+        if len(args) != 1 or args[0][0] not in ('symbol', 'string'):
+            raise Unsupported()
+        prefix = args[0][1].strip('\'').lower()
+        matches = [rev for rev in self.revs
+                   if self.nodes[rev].startswith(prefix)]
+        if len(matches) != 1:
+            # Ambiguous or unknown; let hg produce the right answer or error
+            raise Unsupported()
+        return matches
+
+    # Predicates on metadata
+
+    def _filter(self, predicate):
+        return [rev for rev in self.revs if predicate(rev)]
+
+    def _func_branch(self, args, remote):
+        if len(args) != 1:
+            raise Unsupported()
+        branches = self.branches
+        if args[0][0] == 'string':
+            name = _unquote(args[0], self.encoding)
+            if not name.startswith('re:') and not name.startswith('literal:') \
+                   and name not in self.branch_names:
+                # hg will treat it as a revision; don't try to replicate that
+                raise Unsupported()
+            match = _string_matcher(name)
+            return self._filter(lambda rev: match(branches[rev]))
+        names = set([branches[rev] for rev in self._eval(args[0], remote)])
+        return self._filter(lambda rev: branches[rev] in names)
+
+    def _func_user(self, args, remote):
+        if len(args) != 1:
+            raise Unsupported()
+        match = _string_matcher(_unquote(args[0], self.encoding),
+                                casesensitive=False)
+        authors = self.authors
+        return self._filter(lambda rev: match(authors[rev]))
+
+    _func_author = _func_user
+
+    def _func_date(self, args, remote):
+        if len(args) != 1:
+            raise Unsupported()
+        spec = _unquote(args[0], self.encoding).strip()
+        if spec.startswith('<'):
+            lo, hi = None, _date_bounds(spec[1:])[1]
+        elif spec.startswith('>'):
+            lo, hi = _date_bounds(spec[1:])[0], None
+        elif ' to ' in spec:
+            start, end = spec.split(' to ', 1)
+            lo, hi = _date_bounds(start)[0], _date_bounds(end)[1]
+        else:
+            lo, hi = _date_bounds(spec)
+        dates = self.dates
+        return self._filter(lambda rev: (lo is None or dates[rev] >= lo)
+                            and (hi is None or dates[rev] <= hi))
+
+    def _phase(self, args, phase):
+        if args:
+            raise Unsupported()
+        phases = self.phases
+        return self._filter(lambda rev: phases[rev] == phase)
+
+    def _func_public(self, args, remote):
+        return self._phase(args, 'public')
+
+    def _func_draft(self, args, remote):
+        return self._phase(args, 'draft')
+
+    def _func_secret(self, args, remote):
+        return self._phase(args, 'secret')
+
+    def _func_merge(self, args, remote):
+        if args:
+            raise Unsupported()
+        parents = self.parents
+        return self._filter(lambda rev: len(parents[rev]) > 1)
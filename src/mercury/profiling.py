@@ -0,0 +1,72 @@
+"""Statistics about the queries a Repository runs; see Repository.profile()
+and Queryset.explain()."""
+
+class QueryProfile(object):
+    """Collects statistics about the queries run on a Repository while it
+    is active.  Use it as a context manager:
+
+      with repo.profile() as profile:
+          ...
+      print profile
+
+    Attributes:
+
+      commands      - a list of (revset, server_time, transfer_time, bytes,
+                      rows, parse_time) tuples, one per `hg log' run
+      cache_hits    - the number of queries answered from the query cache
+      cache_misses  - the number of queries that had to run a command
+      server_time   - seconds spent waiting for hg to start sending output,
+                      which is mostly evaluating the revset
+      transfer_time - seconds spent receiving the rest of the output
+      bytes         - the number of bytes of output received
+      rows          - the number of changesets received
+      parse_time    - seconds spent splitting up the output
+      build_time    - seconds spent creating Changesets
+      local_time    - seconds spent evaluating revsets locally (see
+                      Repository.configure_local_evaluation()), including
+                      any parts of them that were sent to hg
+
+    Times are wall-clock times in seconds."""
+
+    _TOTALS = ('cache_hits', 'cache_misses', 'server_time', 'transfer_time',
+               'bytes', 'rows', 'parse_time', 'build_time', 'local_time')
+
+    def __init__(self, repo):
+        self._repo = repo
+        self.commands = []
+        for name in QueryProfile._TOTALS:
+            setattr(self, name, 0)
+
+    def __enter__(self):
+        self._repo._profiles.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._repo._profiles.remove(self)
+
+    def _add(self, **counts):
+        for name, value in counts.iteritems():
+            setattr(self, name, getattr(self, name) + value)
+
+    def _add_command(self, revset, server_time, transfer_time, nbytes, rows,
+                     parse_time):
+        self.commands.append((revset, server_time, transfer_time, nbytes,
+                              rows, parse_time))
+        self._add(server_time=server_time, transfer_time=transfer_time,
+                  bytes=nbytes, rows=rows, parse_time=parse_time)
+
+    def report(self):
+        """Return a human-readable summary of the statistics."""
+        lines = ['commands:  %d (cache: %d hits, %d misses)'
+                 % (len(self.commands), self.cache_hits, self.cache_misses),
+                 'server:    %.1f ms' % (self.server_time * 1000),
+                 'transfer:  %.1f ms, %d bytes, %d rows'
+                 % (self.transfer_time * 1000, self.bytes, self.rows),
+                 'parse:     %.1f ms' % (self.parse_time * 1000),
+                 'build:     %.1f ms' % (self.build_time * 1000)]
+        if self.local_time:
+            lines.append('local:     %.1f ms' % (self.local_time * 1000))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
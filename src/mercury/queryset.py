@@ -1,8 +1,7 @@
 import re
 import datetime
 
-def escape_quote(str):
-    return str.replace('\'', '\\\'')
+from mercury import revset
 
 class Queryset(object):
     """Represents a query on a Mercurial repository."""
@@ -36,142 +35,262 @@ class Queryset(object):
         """Sort the query set by the specified item."""
         return OrderByQueryset(self, *args)
 
-    def _convert(self, item, parens=False):
-        """Convert the specified item to a form suitable for a query."""
+    def _node(self, item):
+        """Convert the specified item to a revset tree."""
         from mercury.repo import Changeset
         
         if isinstance(item, Changeset):
-            return 'id(%s)' % item.node
+            return revset.func('id', revset.symbol(item.node))
         elif isinstance(item, datetime.date) \
              or isinstance(item, datetime.time) \
              or isinstance(item, datetime.datetime):
-            return '\'%s\'' % item.isoformat()
+            return revset.string(item.isoformat())
         elif isinstance(item, basestring):
-            if isinstance(item, unicode):
-                item = item.encode('utf-8')
-            return '\'%s\'' % escape_quote(item)
-        elif parens and isinstance(item, Queryset):
-            return '(%s)' % item
+            return revset.string(item)
+        elif isinstance(item, Queryset):
+            return item._ast()
         else:
-            return str(item)
+            return revset.symbol(str(item))
 
-    def _terms_from_items(self, *items, **kwitems):
-        terms = []
+    def _nodes_from_items(self, *items, **kwitems):
+        func = revset.func
+        string = revset.string
+        
+        nodes = []
         for item in items:
-            terms.append (self._convert(item, parens=True))
+            nodes.append(self._node(item))
 
         for kw,val in kwitems.iteritems():
             if kw in Queryset._STRING_EXPRS:
-                terms.append('%s(\'%s\')' % (kw, escape_quote(val)))
+                nodes.append(func(kw, string(val)))
             elif kw in Queryset._BOOLEAN_EXPRS:
                 if val:
-                    terms.append('%s()' % kw)
+                    nodes.append(func(kw))
             elif kw == 'common_ancestor_of':
                 csets = tuple(val)
-                terms.append('ancestor(%s,%s)' % (self._convert(csets[0]),
-                                                  self._convert(csets[1])))
+                nodes.append(func('ancestor', self._node(csets[0]),
+                                  self._node(csets[1])))
             elif kw == 'ancestors_of':
-                terms.append('ancestors(%s)' % self._convert(val))
+                nodes.append(func('ancestors', self._node(val)))
             elif kw == 'branch':
-                terms.append('branch(%s)' % self._convert(val))
+                nodes.append(func('branch', self._node(val)))
             elif kw == 'children_of':
-                terms.append('children(%s)' % self._convert(val))
+                nodes.append(func('children', self._node(val)))
             elif kw == 'date':
-                terms.append('date(\'%s\')' % val.isoformat())
+                nodes.append(func('date', string(val.isoformat())))
             elif kw == 'date__lt':
                 fmt = val.isoformat()
-                terms.append('(date(<\'%s\') and not date(\'%s\'))'
-                             % (fmt, fmt))
+                nodes.append(revset.and_(func('date', string('<' + fmt)),
+                                         revset.not_(func('date',
+                                                          string(fmt)))))
             elif kw == 'date__lte':
-                terms.append('date(<\'%s\')' % val.isoformat())
+                nodes.append(func('date', string('<' + val.isoformat())))
             elif kw == 'date__gt':
                 fmt = val.isoformat()
-                terms.append('(date(>\'%s\') and not date(\'%s\'))'
-                             % (fmt, fmt))
+                nodes.append(revset.and_(func('date', string('>' + fmt)),
+                                         revset.not_(func('date',
+                                                          string(fmt)))))
             elif kw == 'date__gte':
-                terms.append('date(>\'%s\')' % val.isoformat())
+                nodes.append(func('date', string('>' + val.isoformat())))
             elif kw == 'date__between':
                 val = tuple(val)
-                terms.append('date(\'%s\' to \'%s\')' % (val[0].isoformat(),
-                                                         val[1].isoformat()))
+                nodes.append(func('date', string('%s to %s'
+                                                 % (val[0].isoformat(),
+                                                    val[1].isoformat()))))
             elif kw == 'newer_than_days':
-                terms.append('date(-%s)' % int(val))
+                nodes.append(func('date', string('-%s' % int(val))))
             elif kw == 'older_than_days':
-                terms.append('not date(-%s)' % int(val))
+                nodes.append(revset.not_(func('date',
+                                              string('-%s' % int(val)))))
             elif kw == 'descendant_of':
-                terms.append('descendants(%s)' % self._convert(val))
+                nodes.append(func('descendants', self._node(val)))
             elif kw == 'created_from':
-                terms.append('destination(%s)' % self._convert(val))
+                nodes.append(func('destination', self._node(val)))
             elif kw == 'metadata':
-                subterms = []
+                subnodes = []
                 for k,v in val.iteritems():
                     if v:
-                        if isinstance(v, unicode):
-                            v = v.encode('utf-8')
-                        else:
+                        if not isinstance(v, unicode):
                             v = str(v)
-                            
-                        subterms.append('extra(\'%s\', \'%s\')' % (escape_quote(k),
-                                                                   escape_quote(v)))
+                        subnodes.append(func('extra', string(k), string(v)))
                     else:
-                        subterms.append('extra(\'%s\')' % escape_quote(k))
-                terms.append('(%s)' % ' and '.join(subterms))
+                        subnodes.append(func('extra', string(k)))
+                nodes.append(revset.and_(*subnodes))
             elif kw == 'heads_of':
-                terms.append('heads(%s)' % self._convert(val))
+                nodes.append(func('heads', self._node(val)))
             elif kw == 'newest_in':
-                terms.append('max(%s)' % self._convert(val))
+                nodes.append(func('max', self._node(val)))
             elif kw == 'oldest_in':
-                terms.append('min(%s)' % self._convert(val))
+                nodes.append(func('min', self._node(val)))
             elif kw == 'created':
-                terms.append('origin(%s)' % self._convert(val))
+                nodes.append(func('origin', self._node(val)))
             elif kw == 'parents_of':
-                terms.append('parents(%s)' % self._convert(val))
+                nodes.append(func('parents', self._node(val)))
             elif kw == 'first_parent_of':
-                terms.append('p1(%s)' % self._convert(val))
+                nodes.append(func('p1', self._node(val)))
             elif kw == 'second_parent_of':
-                terms.append('p2(%s)' % self._convert(val))
+                nodes.append(func('p2', self._node(val)))
             elif kw == 'roots_of':
-                terms.append('roots(%s)' % self._convert(val))
+                nodes.append(func('roots', self._node(val)))
             elif kw == 'between':
                 val = tuple(val)
-                terms.append('%s::%s' % (self._convert(val[0], parens=True),
-                                         self._convert(val[1], parens=True)))
+                nodes.append(('dagrange', self._node(val[0]),
+                              self._node(val[1])))
             elif kw == 'between_revisions':
                 val = tuple(val)
-                terms.append('%s:%s' % (self._convert(val[0], parens=True),
-                                        self._convert(val[1], parens=True)))
+                nodes.append(('range', self._node(val[0]),
+                              self._node(val[1])))
                              
-        return terms
-
-    def _terms(self):
-        return []
+        return nodes
+
+    def _build(self):
+        """Return the revset tree for this queryset.  Subclasses override
+        this; it is called at most once per queryset."""
+        if self._base is None:
+            return revset.ALL
+        return self._base._ast()
+
+    def _ast(self):
+        """Return the (unoptimized) revset tree for this queryset."""
+        tree = getattr(self, '_cached_ast', None)
+        if tree is None:
+            tree = self._cached_ast = self._build()
+        return tree
+    
+    def _optimized(self):
+        """Return the optimized revset tree for this queryset."""
+        tree = getattr(self, '_cached_optimized', None)
+        if tree is None:
+            # Reuse the work done for any querysets we're built from
+            memo = {}
+            for dep in (self._base, getattr(self, '_other', None)):
+                done = getattr(dep, '_cached_optimized', None)
+                if done is not None:
+                    memo[id(dep._ast())] = done
+            tree = self._cached_optimized = revset.optimize(self._ast(), memo)
+        return tree
     
     def __str__(self):
-        terms = self._terms()
-        if not terms:
-            return 'all()'
-        return ' and '.join(terms)
+        query = getattr(self, '_cached_str', None)
+        if query is None:
+            query = self._cached_str = revset.render(self._optimized())
+        return query
+
+    def explain(self, analyze=False):
+        """Return a string showing the revset this queryset was built as, and
+        the optimized revset that will actually be run.
+
+        If `analyze' is True, also evaluate the queryset (without caching
+        the results on it) and report how long hg took to evaluate the
+        revset and send the output, how much output there was, how long it
+        took to parse it and build Changesets, and whether the query cache
+        was used.  See Repository.profile()."""
+        plan = 'revset:    %s\noptimized: %s' % (revset.render(self._ast()),
+                                                 self)
+        if not analyze:
+            return plan
+
+        with self._repo.profile() as profile:
+            self._evaluate()
+        return '%s\n%s' % (plan, profile)
+
+    def _evaluate(self):
+        revs = self._local_revs()
+        if revs is not None:
+            return self._repo._csets_for_revs(revs)
+        return list(self._repo.query(str(self)))
 
     def _results(self):
         if getattr(self, '_cached_results', None) is None:
-            self._cached_results = list(self._repo.query(str(self)))
+            self._cached_results = self._evaluate()
         return self._cached_results
 
+    def _local_revs(self):
+        """Return the revision numbers in this queryset, if the repository
+        has local evaluation turned on; otherwise return None."""
+        return self._repo._evaluate_revs(self._optimized())
+
     def __len__(self):
+        # list() asks for this as a length hint, so it must not run a query
+        # of its own; use count() to find the size without the changesets
         return len(self._results())
 
+    def __nonzero__(self):
+        return self.exists()
+
+    def count(self):
+        """Return the number of changesets in this queryset.  Unless the
+        queryset has already been evaluated, this only retrieves their
+        revision numbers."""
+        if getattr(self, '_cached_results', None) is not None:
+            return len(self._cached_results)
+        revs = self._local_revs()
+        if revs is None:
+            revs = self._repo._query_revs(str(self))
+        return len(revs)
+
+    def exists(self):
+        """Return True if this queryset contains any changesets.  At most one
+        revision number is retrieved to find out."""
+        if getattr(self, '_cached_results', None) is not None:
+            return bool(self._cached_results)
+        revs = self._local_revs()
+        if revs is None:
+            revs = self._repo._query_revs('limit(%s, 1)' % self)
+        return bool(revs)
+
+    def first(self):
+        """Return the first Changeset in this queryset, or None if it is
+        empty."""
+        return self._one('first(%s)' % self, 0)
+
+    def last(self):
+        """Return the last Changeset in this queryset, or None if it is
+        empty."""
+        return self._one('last(%s)' % self, -1)
+
+    def _one(self, query, ndx):
+        """Return the changeset at index `ndx' in this queryset, which is
+        what the revset `query' selects, or None."""
+        results = getattr(self, '_cached_results', None)
+        if results is None:
+            revs = self._local_revs()
+            if revs is not None:
+                results = revs[ndx:ndx+1 or None]
+                return results and self._repo._csets_for_revs(results)[0] \
+                       or None
+        if results is not None:
+            try:
+                return results[ndx]
+            except IndexError:
+                return None
+        for cset in self._repo._query_csets(query):
+            return cset
+        return None
+
     def __getitem__(self, key):
         # In cases involving simple slices, we can generate a new queryset
         # as the result, rather than actually performing the query.  If you
-        # use a step, that forces us to do the query, though we might build
-        # an optimized queryset first to select only those items that will
-        # be relevant.
+        # use a step, we fetch just the revision numbers and pick out the
+        # ones we want.  Integer indices fetch only the changeset selected.
         if isinstance(key, slice):
+            if key.step is not None:
+                if key.step > 0:
+                    qset = self[key.start:key.stop]
+                    key = slice(None, None, key.step)
+                else:
+                    qset = self
+                revs = qset._local_revs()
+                if revs is None:
+                    revs = self._repo._query_revs(str(qset))
+                return RevsQueryset(self, revs[key])
+
             stopset = None
             startset = None
             
-            if key.start is not None:
-                if key.start <= 0:
+            # A start of 0 is no bound at all, not the last 0 changesets
+            if key.start:
+                if key.start < 0:
                     startset = LastQueryset(self, -key.start)
                 else:
                     startset = self - FirstQueryset(self, key.start)
@@ -181,25 +300,131 @@ class Queryset(object):
                 else:
                     stopset = self - LastQueryset(self, -key.stop)
 
-            qset = self
             if startset is not None:
                 if stopset is not None:
-                    qset = stopset & startset
-                else:
-                    qset = startset
-            else:
-                qset = stopset
-                
-            if key.step is not None:
-                return qset[::key.step]
-            else:
-                return qset
-                
-        return self._results()[key]
+                    return stopset & startset
+                return startset
+            elif stopset is not None:
+                return stopset
+            return self
+
+        if key >= 0:
+            query = 'limit(%s, 1, %d)' % (self, key)
+        else:
+            query = 'first(last(%s, %d))' % (self, -key)
+        cset = self._one(query, key)
+        if cset is None:
+            raise IndexError('queryset index out of range')
+        return cset
 
     def __iter__(self):
         return iter(self._results())
 
+    def iterator(self, chunk_size=1000, prefetch=False):
+        """Iterate over the changesets in this queryset without keeping them
+        all in memory.
+
+        chunk_size - the number of changesets to fetch at a time
+        prefetch   - if True, fetch each chunk in the background while the
+                     previous one is being processed
+
+        Unlike iterating over the queryset itself, this does not cache the
+        results on the queryset, so each chunk of changesets can be freed
+        once you're done with it.  Use this to walk very large querysets."""
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1')
+
+        results = getattr(self, '_cached_results', None)
+        if results is not None:
+            for cset in results:
+                yield cset
+            return
+
+        revs = self._local_revs()
+        if revs is None:
+            revs = self._repo._query_revs(str(self))
+        for chunk in self._repo._iter_chunks(revs, chunk_size, prefetch):
+            for cset in chunk:
+                yield cset
+
+    def prefetch(self, *kinds, **kwargs):
+        """Load `kinds' of information ('parents', 'changes', 'files' and/or
+        'manifest') for every changeset in this queryset in bulk, instead of
+        a command per changeset as each is used.  Returns the queryset, so
+        you can write
+
+          for cset in repo.changesets.branch('default').prefetch('files'):
+              ...
+
+        See Repository.prefetch()."""
+        self._repo.prefetch(self._results(), *kinds, **kwargs)
+        return self
+
+    _ALL_FIELDS = ('rev', 'node', 'tags', 'branch', 'author', 'desc', 'date',
+                   'p1rev', 'p1node', 'p2rev', 'p2node', 'phase')
+
+    def _values(self, fields):
+        if not fields:
+            fields = Queryset._ALL_FIELDS
+        results = getattr(self, '_cached_results', None)
+        if results is not None:
+            return (tuple([getattr(cset, field) for field in fields])
+                    for cset in results)
+        return self._repo._iter_values(str(self), fields)
+
+    def values(self, *fields):
+        """Yield a dictionary mapping each of `fields' (or, if none are given,
+        every field) to its value, for each changeset in this queryset.
+
+        The fields are the names of Changeset properties: rev, node, tags,
+        branch, author, desc, date, p1rev, p1node, p2rev, p2node and phase.
+        No Changeset objects are created, so this is much cheaper than
+        iterating over the queryset if you only want a few fields."""
+        if not fields:
+            fields = Queryset._ALL_FIELDS
+        for values in self._values(fields):
+            yield dict(zip(fields, values))
+
+    def values_list(self, *fields, **kwargs):
+        """Yield a tuple of the values of `fields' for each changeset in this
+        queryset.  If you pass flat=True and a single field, yield just the
+        values themselves.  See values()."""
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %r'
+                            % (kwargs.keys(),))
+        if flat and len(fields) != 1:
+            raise TypeError('flat=True requires exactly one field')
+        if flat:
+            return (values[0] for values in self._values(fields))
+        return self._values(fields)
+
+    def aggregate(self, group_by=None, metrics=('count',)):
+        """Compute statistics over the changesets in this queryset, grouped
+        by some of their properties.
+
+        group_by - what to group by: one of 'author', 'person', 'email',
+                   'branch', 'phase', 'date:year', 'date:month' and
+                   'date:day', a sequence of them, or None for no grouping
+        metrics  - what to compute for each group: any of 'count', 'files'
+                   (the number of files changed), 'lines_added' and
+                   'lines_removed'
+
+        Returns a dictionary mapping each group (a tuple of values if
+        group_by is a sequence) to a dictionary of metrics, or if group_by
+        is None, just the dictionary of metrics.  e.g.
+
+          >>> repo.changesets.aggregate('date:month', ('count',))
+          {u'2013-01': {'count': 12}, u'2013-02': {'count': 7}}
+
+        This makes a single pass over `hg log' output without creating any
+        Changesets, so it runs in memory proportional to the number of
+        groups, not changesets.  Any metric other than count needs a
+        diffstat of every changeset, which is much slower."""
+        if isinstance(metrics, basestring):
+            metrics = (metrics,)
+        return self._repo._aggregate(str(self), group_by, tuple(metrics))
+
     def __reversed__(self):
         return iter(ReversedQueryset(self))
 
@@ -385,16 +610,16 @@ class BookmarkQueryset(SingleRevQueryset):
         super(BookmarkQueryset, self).__init__(base)
         self._name = name
 
-    def _terms(self):
-        return ['bookmark(\'%s\')' % escape_quote(self._name)]
+    def _build(self):
+        return revset.func('bookmark', revset.string(self._name))
 
     @property
     def name(self):
         return self._name
 
 class TipQueryset(SingleRevQueryset):
-    def _terms(self):
-        return ['tip()']
+    def _build(self):
+        return revset.symbol('tip')
 
     @property
     def name(self):
@@ -405,8 +630,8 @@ class TagQueryset(SingleRevQueryset):
         super(TagQueryset, self).__init__(base)
         self._name = name
 
-    def _terms(self):
-        return ['tag(\'%s\')' % escape_quote(self._name)]
+    def _build(self):
+        return revset.func('tag', revset.string(self._name))
 
     @property
     def name(self):
@@ -419,8 +644,8 @@ class RevQueryset(SingleRevQueryset):
         super(RevQueryset, self).__init__(base)
         self._rev = revision
 
-    def _terms(self):
-        return ['rev(%s)' % self._rev]
+    def _build(self):
+        return revset.func('rev', revset.symbol('%s' % self._rev))
 
     @property
     def name(self):
@@ -431,11 +656,11 @@ class NodeQueryset(SingleRevQueryset):
     def __init__(self, base, node):
         if not isinstance(node, basestring) or not self.NODE_RE.match(node):
             raise TypeError('nodes are specified using a hex string of up to 40 characters')
-        super(RevQueryset, self).__init__(base)
+        super(NodeQueryset, self).__init__(base)
         self._node = node
 
-    def _terms(self):
-        return ['node(%s)' % self._node]
+    def _build(self):
+        return revset.func('id', revset.symbol(self._node))
 
     @property
     def name(self):
@@ -446,97 +671,101 @@ class BranchQueryset(SingleRevQueryset):
         super(BranchQueryset, self).__init__(base)
         self._name = name
 
-    def _terms(self):
-        return ['branch(\'%s\')' % escape_quote(self._name)]
+    def _build(self):
+        return revset.func('branch', revset.string(self._name))
 
     @property
     def name(self):
         return self._name
 
-class TransplantedQueryset(Queryset):
-    def _terms(self):
-        return ['transplanted(%s)' % self._base]
+class FuncQueryset(Queryset):
+    """A queryset that applies the revset function `_func' to its base."""
+    _func = None
+
+    def _build(self):
+        return revset.func(self._func, self._base._ast())
+
+class TransplantedQueryset(FuncQueryset):
+    _func = 'transplanted'
 
-class OriginQueryset(Queryset):
-    def _terms(self):
-        return ['origin(%s)' % self._base]
+class OriginQueryset(FuncQueryset):
+    _func = 'origin'
 
-class MaxQueryset(Queryset):
-    def _terms(self):
-        return ['max(%s)' % self._base]
+class MaxQueryset(FuncQueryset):
+    _func = 'max'
 
-class MinQueryset(Queryset):
-    def _terms(self):
-        return ['min(%s)' % self._base]
+class MinQueryset(FuncQueryset):
+    _func = 'min'
 
-class HeadsQueryset(Queryset):
-    def _terms(self):
-        return ['heads(%s)' % self._base]
+class HeadsQueryset(FuncQueryset):
+    _func = 'heads'
 
-class RootsQueryset(Queryset):
-    def _terms(self):
-        return ['roots(%s)' % self._base]
+class RootsQueryset(FuncQueryset):
+    _func = 'roots'
 
 class FirstQueryset(Queryset):
     def __init__(self, base, count=1):
         super(FirstQueryset, self).__init__(base)
         self._count = count
 
-    def _terms(self):
+    def _build(self):
         if self._count == 1:
-            return ['first(%s)' % self._base]
+            return revset.func('first', self._base._ast())
         else:
-            return ['first(%s, %s)' % (self._base, self._count)]
+            return revset.func('first', self._base._ast(),
+                               revset.symbol('%s' % self._count))
 
 class LastQueryset(Queryset):
     def __init__(self, base, count=1):
         super(LastQueryset, self).__init__(base)
         self._count = count
 
-    def _terms(self):
+    def _build(self):
         if self._count == 1:
-            return ['last(%s)' % self._base]
+            return revset.func('last', self._base._ast())
         else:
-            return ['last(%s, %s)' % (self._base, self._count)]
+            return revset.func('last', self._base._ast(),
+                               revset.symbol('%s' % self._count))
 
-class AncestorsQueryset(Queryset):
-    def _terms(self):
-        return ['ancestors(%s)' % self._base]
+class AncestorsQueryset(FuncQueryset):
+    _func = 'ancestors'
 
-class DestinationQueryset(Queryset):
-    def _terms(self):
-        return ['destination(%s)' % self._base]
+class DestinationQueryset(FuncQueryset):
+    _func = 'destination'
 
-class BranchesQueryset(Queryset):
-    def _terms(self):
-        return ['branch(%s)' % self._base]
+class BranchesQueryset(FuncQueryset):
+    _func = 'branch'
 
-class ChildrenQueryset(Queryset):
-    def _terms(self):
-        return ['children(%s)' % self._base]
+class ChildrenQueryset(FuncQueryset):
+    _func = 'children'
 
-class ParentsQueryset(Queryset):
-    def _terms(self):
-        return ['parents(%s)' % self._base]
+class ParentsQueryset(FuncQueryset):
+    _func = 'parents'
 
-class DescendantsQueryset(Queryset):
-    def _terms(self):
-        return ['descendants(%s)' % self._base]
+class DescendantsQueryset(FuncQueryset):
+    _func = 'descendants'
+
+def _check_cset(what, value):
+    from mercury.repo import Changeset
+    if value is not None and not isinstance(value, (Changeset, long, int)):
+        raise TypeError('%s must be a Changeset, a revision number, or None'
+                        % what)
 
 class CommonAncestorQueryset(Queryset):
     def __init__(self, base, cset1, cset2):
-        if not isinstance(cset1, (Changeset, long, int)) \
-               or not isinstance(cset2, (Changeset, long, int)):
+        if cset1 is None or cset2 is None:
             raise TypeError('Ancestor queries argument must be a Changeset or a revision number')
+        _check_cset('Ancestor queries argument', cset1)
+        _check_cset('Ancestor queries argument', cset2)
 
         super(CommonAncestorQueryset, self).__init__(base)
         self._cset1 = cset1
         self._cset2 = cset2
 
-    def _terms(self):
-        return self._base.terms() \
-               + ['ancestor(%s, %s)' % (self._convert(self._cset1,
-                                                      self._cset2))]
+    def _build(self):
+        return revset.and_(self._base._ast(),
+                           revset.func('ancestor', self._node(self._cset1),
+                                       self._node(self._cset2)))
 
 class ParentQueryset(Queryset):
     def __init__(self, base, n):
@@ -545,89 +774,119 @@ class ParentQueryset(Queryset):
         super(ParentQueryset, self).__init__(base)
         self._n = n
 
-    def _terms(self):
-        return ['(%s)^%s' % (self._base, self._n)]
+    def _build(self):
+        return ('parent', self._base._ast(), self._n)
 
 class RangeQueryset(Queryset):
-    def __init__(self, base, first, last):
-        if first is not None and not isinstance(first, (Changeset, long, int)):
-            raise TypeError('First element in range must be a Changeset, a revision number, or None')
-        if last is not None and not isinstance(last, (Changeset, long, int)):
-            raise TypeError('Last element in range must be a Changeset, a revision number, or None')
+    _op = 'dagrange'
 
-        super(RangeQueryset, self).__init__(base)
-        self._first = first
-        self._last = last
-
-    def _terms(self):
-        return self._base._terms() + ['%s::%s' % (self._convert(first,
-                                                                parens=True),
-                                                  self._convert(last,
-                                                                parens=True))]
-    
-class RevRangeQueryset(Queryset):
     def __init__(self, base, first, last):
-        if first is not None and not isinstance(first, (Changeset, long, int)):
-            raise TypeError('First element in range must be a Changeset, a revision number, or None')
-        if last is not None and not isinstance(last, (Changeset, long, int)):
-            raise TypeError('Last element in range must be a Changeset, a revision number, or None')
+        _check_cset('First element in range', first)
+        _check_cset('Last element in range', last)
 
         super(RangeQueryset, self).__init__(base)
         self._first = first
         self._last = last
 
-    def _terms(self):
-        return self._base._terms() + ['%s:%s' % (self._convert(first,
-                                                               parens=True),
-                                                 self._convert(last,
-                                                               parens=True))]
+    def _build(self):
+        first = last = None
+        if self._first is not None:
+            first = self._node(self._first)
+        if self._last is not None:
+            last = self._node(self._last)
+        return revset.and_(self._base._ast(), (self._op, first, last))
     
-class AndQueryset(Queryset):
-    def __init__(self, base, other):
-        if base._repo != other._repo:
-            raise ValueError('Cannot AND Querysets from different repositories')
+class RevRangeQueryset(RangeQueryset):
+    _op = 'range'
+
+class RevsQueryset(Queryset):
+    """A queryset containing an explicit list of revisions, in order."""
+    def __init__(self, base, revs):
+        super(RevsQueryset, self).__init__(base)
+        self._revs = revs
+
+    def _build(self):
+        # _intlist() is internal to Mercurial, but unlike a chain of rev()s
+        # it preserves the order we give and copes with very long lists
+        return revset.func('_intlist',
+                           revset.string('\\x00'.join([str(rev)
+                                                       for rev in self._revs])))
+
+class SetOpQueryset(Queryset):
+    """Base class for querysets that combine two others.  If both of those
+    have already been evaluated, the result is worked out from their
+    Changesets, without asking hg; this happens lazily, when the result is
+    first needed."""
+    _verb = None
 
-        super(AndQueryset, self).__init__(base)
-        self._other = other
-        
-    def _terms(self):
-        return self._base._terms() + self._other._terms()
-
-class OrQueryset(Queryset):
     def __init__(self, base, other):
         if base._repo != other._repo:
-            raise ValueError('Cannot OR Querysets from different repositories')
-        
-        super(OrQueryset, self).__init__(base)
-        self._other = other
+            raise ValueError('Cannot %s Querysets from different repositories'
+                             % self._verb)
 
-    def _terms(self):
-        return self._base._terms() + self._other._terms()
+        super(SetOpQueryset, self).__init__(base)
+        self._other = other
+        self._stored_results = None
 
-    def __str__(self):
-        terms = self._terms()
-        if not terms:
-            return 'all()'
-        return ' or '.join(terms)
+    @property
+    def _cached_results(self):
+        if self._stored_results is None:
+            base = getattr(self._base, '_cached_results', None)
+            other = getattr(self._other, '_cached_results', None)
+            if base is not None and other is not None:
+                self._stored_results = self._combine(base, other)
+        return self._stored_results
+
+    @_cached_results.setter
+    def _cached_results(self, results):
+        self._stored_results = results
+
+    def _combine(self, base, other):
+        raise NotImplementedError()
+
+class AndQueryset(SetOpQueryset):
+    _verb = 'AND'
+
+    def _build(self):
+        return revset.and_(self._base._ast(), self._other._ast())
+
+    def _combine(self, base, other):
+        # Like hg, keep the order of the left hand side
+        revs = set([cset.rev for cset in other])
+        return [cset for cset in base if cset.rev in revs]
+
+class OrQueryset(SetOpQueryset):
+    _verb = 'OR'
+
+    def _build(self):
+        return revset.or_(self._base._ast(), self._other._ast())
+
+    def _combine(self, base, other):
+        # Like hg, the left hand side, then whatever the right hand side adds
+        revs = set([cset.rev for cset in base])
+        result = list(base)
+        for cset in other:
+            if cset.rev not in revs:
+                revs.add(cset.rev)
+                result.append(cset)
+        return result
 
 class NotQueryset(Queryset):
-    def _terms(self):
-        return ['not (%s)' % self._base]
+    def _build(self):
+        return revset.not_(self._base._ast())
 
-class DiffQueryset(Queryset):
-    def __init__(self, base, other):
-        if base._repo != other._repo:
-            raise ValueError('Cannot subtract Querysets from different repositories')
+class DiffQueryset(SetOpQueryset):
+    _verb = 'subtract'
 
-        super(DiffQueryset, self).__init__(base)
-        self._other = other
+    def _build(self):
+        return ('minus', self._base._ast(), self._other._ast())
 
-    def _terms(self):
-        return ['(%s) - (%s)' % (self._base, self._other)]
+    def _combine(self, base, other):
+        revs = set([cset.rev for cset in other])
+        return [cset for cset in base if cset.rev not in revs]
 
-class ReversedQueryset(Queryset):
-    def _terms(self):
-        return ['reverse(%s)' % self._base]
+class ReversedQueryset(FuncQueryset):
+    _func = 'reverse'
 
 class ExcludeQueryset(Queryset):
     def __init__(self, base, *args, **kwargs):
@@ -635,12 +894,10 @@ class ExcludeQueryset(Queryset):
         self._items = args
         self._kwitems = kwargs
 
-    def _terms(self):
-        return self._base._terms() \
-               + ['not (%s)' \
-                  % ' or '.join(self._terms_from_items(*self._items,
-                                                       **self._kwitems))]
-
+    def _build(self):
+        return revset.and_(self._base._ast(),
+                           revset.not_(revset.or_(*self._nodes_from_items(*self._items,
+                                                                          **self._kwitems))))
 
 class FilterQueryset(Queryset):
     def __init__(self, base, *args, **kwargs):
@@ -648,19 +905,19 @@ class FilterQueryset(Queryset):
         self._items = args
         self._kwitems = kwargs
 
-    def _terms(self):
-        return self._base._terms() \
-               + self._terms_from_items(*self._items, **self._kwitems)
+    def _build(self):
+        return revset.and_(self._base._ast(),
+                           *self._nodes_from_items(*self._items,
+                                                   **self._kwitems))
 
 class OrderByQueryset(Queryset):
     def __init__(self, base, *args):
         super(OrderByQueryset, self).__init__(base)
         self._items = args
 
-    def _terms(self):
+    def _build(self):
         if len(self._items):
-            return ['sort(%s, %s)' % (self._base, ', '.join(self._items))]
+            return revset.func('sort', self._base._ast(),
+                               revset.string(' '.join(self._items)))
         else:
-            return ['sort(%s)' % self._base]
-
-                                     
+            return revset.func('sort', self._base._ast())
@@ -11,12 +11,25 @@ import pipes
 import threading
 import urlparse
 import itertools
+import zlib
+import sys
+import Queue
+import array
+import copy
+import stat
+import time
 
 from mercury.client import Client, SimpleErrorHandler
 from mercury.exceptions import *
 from mercury.queryset import RepoQueryset, Queryset, SingleRevQueryset
-from mercury.utils import every, LRUCache, datetime_from_timestamp
+from mercury.utils import every, SizedLRUCache
+from mercury.dates import from_hgdate, from_datestr, from_timestamp
+# SimpleTzInfo used to live here; keep mercury.repo.SimpleTzInfo working
+from mercury.dates import SimpleTzInfo
 from mercury import diffparser
+from mercury import local
+from mercury.profiling import QueryProfile
+from mercury.change import Change
 
 class AnnotatedString(unicode):
     __slots__ = ['user', 'file', 'date', 'changeset', 'line']
@@ -50,25 +63,111 @@ class GrepResult(object):
         if not m:
             return self.user
         return m.group(1)
+
+class FileListing(object):
+    """The result of Repository.ls() with columnar=True.
+
+    Each field you asked for is available as a column, e.g. listing['name'];
+    names and string fields are lists, while 'mode' and 'size' are arrays of
+    integers, 'rev' is an array of revision numbers (-1 if there is none) and
+    'date' is an array of UNIX timestamps.  Changesets and datetimes are only
+    created when you ask for them, using changeset() and date()."""
+    
+    def __init__(self, repo, fields, columns, nodes=None, subrepos=None,
+                 offsets=None):
+        self._repo = repo
+        self._fields = tuple(fields)
+        self._columns = columns
+        self._nodes = nodes
+        self._subrepos = subrepos
+        self._offsets = offsets
+
+    @property
+    def fields(self):
+        return self._fields
     
-class SimpleTzInfo(datetime.tzinfo):
-    __slots__ = ['_offset']
-    def __init__(self, offset):
-        self._offset = offset
+    def __len__(self):
+        if not self._fields:
+            return 0
+        return len(self._columns[self._fields[0]])
+
+    def __getitem__(self, field):
+        return self._columns[field]
+
+    def changeset(self, ndx):
+        """Return the Changeset at which entry `ndx' last changed."""
+        rev = self._columns['rev'][ndx]
+        if rev == -1:
+            return None
+        subrepo = self._subrepos[ndx]
+        if subrepo:
+            repo = self._repo._subrepo(subrepo)
+        else:
+            repo = self._repo
+        return repo._get_lazy(rev, self._nodes[ndx])
+
+    def date(self, ndx):
+        """Return the date of the revision at which entry `ndx' last
+        changed, as a datetime."""
+        return from_timestamp(self._columns['date'][ndx], self._offsets[ndx])
+
+    def rows(self):
+        """Yield tuples in the same form as Repository.ls() without
+        columnar=True."""
+        for ndx in xrange(len(self)):
+            row = []
+            for field in self._fields:
+                if field == 'rev':
+                    row.append(self.changeset(ndx))
+                elif field == 'date':
+                    row.append(self.date(ndx))
+                else:
+                    row.append(self._columns[field][ndx])
+            yield tuple(row)
+
+def _strip_eol(text):
+    if text.endswith('\n'):
+        text = text[:-1]
+        if text.endswith('\r'):
+            text = text[:-1]
+    return text
+
+def _patch_annotation(old, hunks, new_line):
+    """Apply the TextHunks in `hunks' to the annotation `old' (a list of
+    AnnotatedStrings), calling new_line(lineno, text) to annotate each added
+    line.  Returns the new annotation, or None if the hunks don't match."""
+    result = []
+    pos = 0
+    for hunk in hunks:
+        if hunk.binary:
+            return None
 
-    def utcoffset(self, dt):
-        return datetime.timedelta(minutes=self._offset)
+        # A hunk that removes nothing starts *after* line start_a
+        if hunk.len_a:
+            start = hunk.start_a - 1
+        else:
+            start = hunk.start_a
+        if start < pos or start > len(old):
+            return None
+        result.extend(old[pos:start])
+        pos = start
 
-    def dst(self, dt):
-        return datetime.timedelta(0)
+        for op, text in hunk.lines:
+            if op == '+':
+                result.append(new_line(len(result) + 1, text))
+                continue
+            if pos >= len(old):
+                return None
+            if op == ' ':
+                result.append(old[pos])
+            pos += 1
+
+    result.extend(old[pos:])
+    return result
 
-    def tzname(self, dt):
-        if self._offset > 0:
-            d, r = divmod(self._offset, 60)
-            return '+%02s%02s' % (d, r)
-        elif self._offset < 0:
-            d, r = divmod(-self._offset, 60)
-            return '-%02s%02s' % (d, r)
+def _annotation_size(lines):
+    """Estimate the memory used by a list of AnnotatedStrings."""
+    return sum([len(l) for l in lines]) + 128 * len(lines)
 
 class Changeset(object):
     PUBLIC = 'public'
@@ -82,6 +181,7 @@ class Changeset(object):
         self._node = node
         self._parents = None
         self._manifest = None
+        self._files = None
         self._fetched = False
         if info:
             self._init_from_info(info)
@@ -252,6 +352,13 @@ class Changeset(object):
             self._fetch_manifest()
         return self._manifest
 
+    @property
+    def files(self):
+        """The paths of the files this changeset touched."""
+        if self._files is None:
+            self._repo._fetch_files([self])
+        return self._files
+
     def changes(self,
                 ignore_all_space=False,
                 ignore_space_change=False,
@@ -270,8 +377,7 @@ class Changeset(object):
         self._branch = info[3]
         self._author = info[4]
         self._desc = info[5]
-        utc = float(info[6].split('.', 1)[0])
-        self._date = datetime_from_timestamp(utc)
+        self._date = from_hgdate(info[6])
         self._p1rev = int(info[7])
         self._p1node = info[8]
         self._p2rev = int(info[9])
@@ -296,7 +402,7 @@ class BaseRepo(object):
     def _cset_from_info(self, info):
         cset = self._live_changesets.get(info[1])
         if not cset:
-            cset = Changeset(self, info[0], info[1], info)
+            cset = Changeset(self, int(info[0]), info[1], info)
             self._live_changesets[info[1]] = cset
         return cset
     
@@ -327,18 +433,183 @@ class RemoteRepository(BaseRepo):
     def query(self, *args, **kwargs):
         raise RemoteRepositoryError('cannot query a remote repository')
 
+    def _query_revs(self, revset):
+        raise RemoteRepositoryError('cannot query a remote repository')
+
+    def _query_csets(self, revset):
+        raise RemoteRepositoryError('cannot query a remote repository')
+
+    def _evaluate_revs(self, tree):
+        return None
+
     def open(self, name, mode, rev):
         raise RemoteRepositoryError('cannot open a file from a remote repository')
 
+_STATUS_MAP = { 'M': 'modified',
+                'A': 'added',
+                'R': 'removed',
+                'C': 'clean',
+                '!': 'missing',
+                '?': 'untracked',
+                'I': 'ignored',
+                ' ': 'original' }
+
+def _parse_status(out):
+    """Parse the output of `hg status --print0' into a list of
+    (<status>, <path>) pairs."""
+    result = []
+    for entry in out.split('\0'):
+        if entry:
+            status, name = entry[0], entry[2:]
+            result.append((_STATUS_MAP[status], name))
+    return result
+
+def _file_state(paths):
+    """Return a token describing the state of the files in `paths'; the
+    token changes whenever any of them is created, deleted or rewritten.
+    For directories, the token also covers the `.rc' files within."""
+    state = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            state.append(None)
+            continue
+
+        state.append((st.st_ino, st.st_size, st.st_mtime))
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                names = sorted([name for name in os.listdir(path)
+                                if name.endswith('.rc')])
+            except OSError:
+                names = []
+            state.append(_file_state([os.path.join(path, name)
+                                      for name in names]))
+    return tuple(state)
+
+def _user_config_files():
+    """Return the hgrc files (and hgrc.d directories) outside of any
+    repository that Mercurial will read."""
+    rcpath = os.environ.get('HGRCPATH')
+    if rcpath is not None:
+        return [path for path in rcpath.split(os.pathsep) if path]
+
+    home = os.path.expanduser('~')
+    xdg_config = os.environ.get('XDG_CONFIG_HOME',
+                                os.path.join(home, '.config'))
+    return ['/etc/mercurial/hgrc',
+            '/etc/mercurial/hgrc.d',
+            os.path.join(home, '.hgrc'),
+            os.path.join(xdg_config, 'hg', 'hgrc')]
+
+def _intlist(revs):
+    """Return a revset selecting the revision numbers `revs', in order."""
+    return '_intlist(\'%s\')' % '\\x00'.join([str(rev) for rev in revs])
+
+def _template_escape(text):
+    """Escape `text' for use in a double-quoted template string."""
+    return text.replace('\\', '\\\\').replace('"', '\\"') \
+               .replace('{', '\\{')
+
 _thread_local = threading.local()
 
+def _close_client(client, kill=False):
+    """Shut down `client''s command server, if it is running.  If `kill' is
+    True, don't wait for it to finish what it was doing."""
+    if client._server is None:
+        return
+    try:
+        if kill:
+            client._server.terminate()
+        client.disconnect()
+    except (IOError, OSError):
+        client._server = None
+
+class _ClientPool(object):
+    """The spare Clients a Repository keeps for running commands in
+    parallel.  This holds no reference to the Repository, so that their
+    servers are shut down when it goes away, even as part of a cycle."""
+    def __init__(self):
+        self.clients = []
+
+    def close(self):
+        clients, self.clients = self.clients, []
+        for client in clients:
+            _close_client(client)
+
+    def __del__(self):
+        self.close()
+
+def _diff_worker(client, todo, done, stop, lazy, failed):
+    """Thread body used by Repository.changes_many(); generates and parses
+    diffs for the (index, node) pairs in `todo', putting the results into
+    `done'.  If a command fails, `client' is added to `failed' and the
+    thread stops using it."""
+    while not stop.is_set():
+        try:
+            ndx, node = todo.get_nowait()
+        except Queue.Empty:
+            return
+
+        try:
+            raw = client.execute('diff', c=node, g=True, binary=True)
+        except Exception:
+            failed.append(client)
+            done.put((ndx, None, None, sys.exc_info()))
+            return
+
+        try:
+            changes = list(diffparser.parse(raw, lazy=lazy))
+            done.put((ndx, raw, changes, None))
+        except Exception:
+            done.put((ndx, None, None, sys.exc_info()))
+
+def _chunk_worker(client, revset, result):
+    """Thread body used by Repository._iter_chunks(); fetches changeset
+    information for `revset', appending (infos, exc_info) to `result'."""
+    try:
+        out = client.execute('log', template=Repository._TEMPLATE, r=revset)
+        result.append(([chunk for chunk in every(out.split('\0'), 12)], None))
+    except Exception:
+        result.append((None, sys.exc_info()))
+
+def _manifest_worker(client, todo, done, stop, failed):
+    """Thread body used by Repository.prefetch(); lists the manifests of
+    the (index, node) pairs in `todo', putting the raw output into `done'.
+    If a command fails, `client' is added to `failed' and the thread stops
+    using it."""
+    while not stop.is_set():
+        try:
+            ndx, node = todo.get_nowait()
+        except Queue.Empty:
+            return
+
+        try:
+            out = client.execute('list', r=node, recursive=True, all=True,
+                                 template=Repository._LIST_TEMPLATE,
+                                 binary=True)
+            done.put((ndx, out, None))
+        except Exception:
+            failed.append(client)
+            done.put((ndx, None, sys.exc_info()))
+            return
+
 class Repository(BaseRepo):
     """Represents a Mercurial repository."""
-    _TEMPLATE = r'{rev}\0{node}\0{tags}\0{branch}\0{author}\0{desc}\0{date}\0{p1rev}\0{p1node}\0{p2rev}\0{p2node}\0{phase}\0'
+    _TEMPLATE = r'{rev}\0{node}\0{tags}\0{branch}\0{author}\0{desc}\0{date|hgdate}\0{p1rev}\0{p1node}\0{p2rev}\0{p2node}\0{phase}\0'
     _LIST_TEMPLATE = r'{rev}\0{node}\0{name}\0'
+    _FILES_TEMPLATE = r'{rev}\0{join(files, "\n")}\0'
+    _GRAPH_TEMPLATE = r'{rev}\0{node}\0{p1rev}\0{p2rev}\0{branch}\0{author}\0{date|hgdate}\0{phase}\0'
+    _ANNOTATE_TEMPLATE = r'{path}\0{lines|count}\0{lines % "{rev}\0{node}\0{user}\0{date|hgdate}\0{path}\0{lineno}\0{line}\0"}'
     
     _LRU_CACHE_SIZE = 16
 
+    # The number of changesets whose diffs prefetch() asks for at once
+    _PREFETCH_CHUNK = 100
+    _CHANGE_CACHE_SIZE = 64 * 1024 * 1024
+    _ANNOTATE_CACHE_SIZE = 16 * 1024 * 1024
+    _QUERY_CACHE_SIZE = 65536
+
     def __new__(cls, path, encoding='utf-8', client=None):
         live_repos = getattr(_thread_local, 'live_repos', None)
         if live_repos is None:
@@ -376,7 +647,21 @@ class Repository(BaseRepo):
         self._path = path
         self._client = client
         self._lru_cache = []
-        self._change_cache = LRUCache(16)
+        self._change_cache = SizedLRUCache(Repository._CHANGE_CACHE_SIZE)
+        self._compress_changes = False
+        self._lazy_changes = False
+        self._annotate_cache = SizedLRUCache(Repository._ANNOTATE_CACHE_SIZE,
+                                             _annotation_size)
+        self._client_pool = _ClientPool()
+        self._subrepos = {}
+        self._metadata = {}
+        self._metadata_files = self._find_metadata_files()
+        self._query_cache = SizedLRUCache(Repository._QUERY_CACHE_SIZE,
+                                          lambda (token, infos): len(infos) + 1)
+        self._local_evaluation = False
+        self._profiles = []
+        self._graph = None
+        self._graph_token = None
         
         # Replace clone() with a non-static version
         def new_clone(self, *args, **kwargs):
@@ -425,17 +710,650 @@ class Repository(BaseRepo):
         self._lru_cache.append(cset)
 
     def _fetch_changes(self, cset):
-        changes = self._change_cache[cset.node]
+        changes = self._cached_changes(cset.node)
         if changes is None:
-            changes = list(self.changes(change=cset))
-            self._change_cache[cset.node] = changes
+            raw = self.diff(change=cset, git=True)
+            changes = list(diffparser.parse(raw, lazy=self._lazy_changes))
+            self._cache_changes(cset.node, raw, changes)
         return changes
 
+    def _cached_changes(self, node):
+        """Return the cached Changes for `node', or None."""
+        cached = self._change_cache[node]
+        if cached is not None and self._compress_changes:
+            return list(diffparser.parse(zlib.decompress(cached),
+                                         lazy=self._lazy_changes))
+        return cached
+
+    def _cache_changes(self, node, raw, changes):
+        """Add the parsed form of the diff `raw' to the changes cache."""
+        if self._compress_changes:
+            data = zlib.compress(raw)
+            self._change_cache.add(node, data, len(data))
+        else:
+            size = sum([c._estimated_size() for c in changes])
+            self._change_cache.add(node, changes, size)
+
+    def configure_change_cache(self, size=None, compressed=None, lazy=None):
+        """Configure the cache used to hold the Change objects for
+        Changesets you have iterated over.
+
+        size       - the maximum (estimated) size of the cache, in bytes
+        compressed - if True, hold the raw diff in compressed form and re-parse
+                     it on demand, rather than holding the parsed Changes
+        lazy       - if True, parse diffs lazily (see diffparser.parse()), so
+                     that hunk lines are only split up when you look at them;
+                     the cache then holds the diff text rather than lines
+
+        Changing `compressed' or `lazy' empties the cache.  A lazily parsed
+        entry counts as the size it will have once all its lines have been
+        read, so the cache stays within `size' however much of it you
+        look at."""
+        if compressed is not None and bool(compressed) != self._compress_changes:
+            self._compress_changes = bool(compressed)
+            self._change_cache.clear()
+        if lazy is not None and bool(lazy) != self._lazy_changes:
+            self._lazy_changes = bool(lazy)
+            self._change_cache.clear()
+        if size is not None:
+            self._change_cache.resize(size)
+
+    @property
+    def change_cache_info(self):
+        """Return a dictionary describing the occupancy of the changes
+        cache, containing
+
+          'entries'    - the number of Changesets whose changes are cached
+          'size'       - the estimated size of the cache contents, in bytes
+          'max_size'   - the maximum size of the cache, in bytes
+          'compressed' - True if raw diffs are cached in compressed form
+          'lazy'       - True if diffs are parsed lazily
+          'hits'       - the number of lookups that found an entry
+          'misses'     - the number of lookups that did not"""
+        cache = self._change_cache
+        return { 'entries': len(cache),
+                 'size': cache.size,
+                 'max_size': cache.max_size,
+                 'compressed': self._compress_changes,
+                 'lazy': self._lazy_changes,
+                 'hits': cache.hits,
+                 'misses': cache.misses }
+
+    def _find_metadata_files(self):
+        """Work out which files need to be checked to tell whether the
+        cached results of tags(), branches() and so on are still valid."""
+        hgdir = os.path.join(self._path, '.hg')
+        shared = hgdir
+        try:
+            with open(os.path.join(hgdir, 'sharedpath')) as f:
+                shared = f.read().strip()
+        except IOError:
+            pass
+
+        # Anything that adds, strips, hides or changes the phase of a
+        # changeset touches one of these.  The tags and branch caches that
+        # hg keeps are derived from them.
+        store = os.path.join(shared, 'store')
+        history = [os.path.join(store, name)
+                   for name in ('00changelog.i', '00changelog.d',
+                                'phaseroots', 'obsstore')]
+        bookmarks = [os.path.join(hgdir, 'bookmarks'),
+                     os.path.join(shared, 'bookmarks'),
+                     os.path.join(hgdir, 'bookmarks.current')]
+        localtags = [os.path.join(hgdir, 'localtags')]
+        config = [os.path.join(hgdir, 'hgrc')] + _user_config_files()
+
+        # Revsets can refer to any of the above, to aliases defined in the
+        # configuration, and to the working directory's parents and the
+        # bisection state
+        query = history + bookmarks + localtags + config \
+                + [os.path.join(hgdir, 'dirstate'),
+                   os.path.join(hgdir, 'bisect.state')]
+
+        return { 'graph': history,
+                 'tags': history + localtags,
+                 'branches': history,
+                 'bookmarks': history + bookmarks,
+                 'paths': config,
+                 'config': config,
+                 'query': query }
+
+    def _cached_metadata(self, kind, key, compute):
+        """Return the cached result of compute() for `key', provided
+        none of the files that `kind' of metadata depends on have changed;
+        otherwise call compute() and cache its result."""
+        # Take the token *before* running the command, so that a change made
+        # while it runs will be noticed next time
+        token = _file_state(self._metadata_files[kind])
+        cached = self._metadata.get(key)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+
+        result = compute()
+        self._metadata[key] = (token, result)
+        return result
+
+    def invalidate_metadata(self):
+        """Discard the cached results of tags(), branches(), bookmarks(),
+        paths(), config() and query().  You should only need this if you
+        have changed the repository in some way that the caches can't
+        detect, e.g. via a config file pulled in with %include."""
+        self._metadata.clear()
+        self._query_cache.clear()
+
+    # Revsets whose results depend on something other than the state of the
+    # repository (the time, or another repository) are never cached
+    _UNCACHEABLE_RE = re.compile(r"\b(?:outgoing|remote)\s*\(|\bdate\s*\(\s*['\"]?-"
+                                 r"|\b(?:today|yesterday|now)\b")
+
+    def _query_cached(self, key, revset, fetch):
+        """Return fetch(revset), sharing the result between identical
+        requests for as long as the repository doesn't change."""
+        if Repository._UNCACHEABLE_RE.search(revset):
+            self._note(cache_misses=1)
+            return fetch(revset)
+
+        token = _file_state(self._metadata_files['query'])
+        cached = self._query_cache[key]
+        if cached is not None and cached[0] == token:
+            self._note(cache_hits=1)
+            return cached[1]
+
+        self._note(cache_misses=1)
+        result = fetch(revset)
+        self._query_cache[key] = (token, result)
+        return result
+
+    def _query_infos(self, revset):
+        """Return the changeset information for the changesets matched by
+        `revset'."""
+        return self._query_cached(revset, revset, self._fetch)
+
+    def _query_revs(self, revset):
+        """Return just the revision numbers of the changesets matched by
+        `revset'."""
+        return self._query_cached(('revs', revset), revset, self._fetch_revs)
+
+    def _query_revs_many(self, revsets):
+        """Return a list of the revision numbers matched by each of
+        `revsets', running a single command for any not in the query
+        cache."""
+        token = _file_state(self._metadata_files['query'])
+        results = {}
+        missing = []
+        for revset in revsets:
+            if revset in results:
+                continue
+            cached = None
+            if not Repository._UNCACHEABLE_RE.search(revset):
+                cached = self._query_cache[('revs', revset)]
+            if cached is not None and cached[0] == token:
+                self._note(cache_hits=1)
+                results[revset] = cached[1]
+            else:
+                self._note(cache_misses=1)
+                results[revset] = None
+                missing.append(revset)
+
+        if missing:
+            for revset, revs in itertools.izip(missing,
+                                               self._fetch_rev_lists(missing)):
+                results[revset] = revs
+                if not Repository._UNCACHEABLE_RE.search(revset):
+                    self._query_cache[('revs', revset)] = (token, revs)
+
+        return [results[revset] for revset in revsets]
+
+    def _query_csets(self, revset):
+        """Yield Changesets for the (already formatted) revset `revset'."""
+        return self._csets_from_infos(self._query_infos(revset))
+
+    def _csets_from_infos(self, infos):
+        """Yield Changesets for the changeset information in `infos'."""
+        profiles = self._profiles
+        for info in infos:
+            if profiles:
+                start = time.time()
+            cset = self._live_changesets.get(info[1])
+            if not cset:
+                cset = Changeset(self, int(info[0]), info[1], info)
+                self._live_changesets[info[1]] = cset
+            self._update_cache(cset)
+            if profiles:
+                self._note(build_time=time.time() - start)
+            yield cset
+
+    def evaluate_many(self, querysets):
+        """Evaluate a number of Querysets at once.  However many there are,
+        this runs at most two commands: one to find the changesets each
+        queryset matches and one to fetch those we don't already have.
+
+        The results are cached on each Queryset, just as if you had
+        iterated over it, so carry on using the querysets as normal.
+        Returns a list of the querysets' results (lists of Changesets).
+
+        If any of the querysets is invalid, the resulting CommandError
+        doesn't tell you which one."""
+        querysets = list(querysets)
+        revs = {}
+        remote = []
+        for qs in querysets:
+            if getattr(qs, '_cached_results', None) is None:
+                local_revs = qs._local_revs()
+                if local_revs is None:
+                    remote.append(qs)
+                else:
+                    revs[id(qs)] = local_revs
+
+        remote_revs = self._query_revs_many([str(qs) for qs in remote])
+        for qs, qs_revs in itertools.izip(remote, remote_revs):
+            revs[id(qs)] = qs_revs
+
+        needed = sorted(set(itertools.chain(*revs.values())))
+        csets = dict(itertools.izip(needed, self._csets_for_revs(needed)))
+        for qs in querysets:
+            qs_revs = revs.get(id(qs))
+            if qs_revs is not None:
+                qs._cached_results = [csets[rev] for rev in qs_revs]
+
+        return [qs._results() for qs in querysets]
+
+    def profile(self):
+        """Return a QueryProfile that, while active, collects statistics
+        about the queries run on this repository: the time hg spends
+        evaluating them, the output transferred, the time taken to parse it
+        and build Changesets, and query cache hits and misses.  e.g.
+
+          with repo.profile() as profile:
+              render_dashboard(repo)
+          print profile
+
+        See also Queryset.explain()."""
+        return QueryProfile(self)
+
+    def _note(self, **counts):
+        """Add `counts' to any active QueryProfiles."""
+        for profile in self._profiles:
+            profile._add(**counts)
+
+    def configure_local_evaluation(self, enabled=True):
+        """Turn local evaluation of Querysets on or off.
+
+        When it is on, the parent graph, branch, author, date and phase of
+        every changeset are loaded into memory (once, and again after the
+        repository changes), and Querysets are evaluated against that as
+        far as possible.  Only the parts that need more information, such
+        as file() or grep(), are sent to hg.  This is worthwhile if you
+        run many graph queries (ancestors, heads, revision ranges...)
+        against a repository that doesn't change often."""
+        self._local_evaluation = bool(enabled)
+        if not enabled:
+            self._graph = self._graph_token = None
+
+    def _local_graph(self):
+        """Return the local.Graph for this repository, or None if local
+        evaluation is turned off."""
+        if not self._local_evaluation:
+            return None
+
+        token = _file_state(self._metadata_files['graph'])
+        if self._graph is None or token != self._graph_token:
+            out = self._client.execute('log', r='all()',
+                                       template=Repository._GRAPH_TEMPLATE)
+            infos = []
+            for rev, node, p1, p2, branch, author, date, phase \
+                    in every(out.split('\0'), 8):
+                infos.append((int(rev), node, int(p1), int(p2), branch,
+                              author, float(date.split(' ', 1)[0]), phase))
+            self._graph = local.Graph(infos, self._client.encoding)
+            self._graph_token = token
+        return self._graph
+
+    def _evaluate_revs(self, tree):
+        """Return the revision numbers selected by the revset tree `tree',
+        evaluating as much of it locally as possible, or None if local
+        evaluation is turned off."""
+        graph = self._local_graph()
+        if graph is None:
+            return None
+        if not self._profiles:
+            return graph.evaluate(tree, self._query_revs)
+
+        start = time.time()
+        revs = graph.evaluate(tree, self._query_revs)
+        self._note(local_time=time.time() - start)
+        return revs
+
+    def _csets_for_revs(self, revs):
+        """Return a list of Changesets for the revision numbers `revs', in
+        the same order, fetching any we haven't already got in one go."""
+        graph = self._local_graph()
+        csets = {}
+        missing = []
+        for rev in revs:
+            cset = None
+            if graph is not None:
+                cset = self._live_changesets.get(graph.nodes[rev])
+            if cset is not None and cset._fetched:
+                csets[rev] = cset
+            else:
+                missing.append(rev)
+
+        # These lists are rarely asked for twice, and could be huge, so they
+        # bypass the query cache rather than evicting useful entries
+        if missing:
+            for cset in self._csets_from_infos(self._fetch(_intlist(missing))):
+                csets[cset.rev] = cset
+
+        return [csets[rev] for rev in revs]
+
+    def _iter_chunks(self, revs, chunk_size, prefetch=False):
+        """Yield lists of Changesets for the revision numbers `revs', at most
+        `chunk_size' at a time.  Nothing is kept in the query cache, so each
+        chunk can be freed as soon as the caller is done with it.
+
+        If `prefetch' is True, each chunk is fetched by a background thread,
+        on a Client of its own, while the caller works on the one before."""
+        if not prefetch:
+            for start in xrange(0, len(revs), chunk_size):
+                infos = self._fetch(_intlist(revs[start:start+chunk_size]))
+                yield list(self._csets_from_infos(infos))
+            return
+
+        clients = self._take_clients(1)
+        failed = []
+        thread = None
+
+        def fetch(start):
+            result = []
+            thread = threading.Thread(
+                target=_chunk_worker,
+                args=(clients[0], _intlist(revs[start:start+chunk_size]),
+                      result))
+            thread.daemon = True
+            thread.start()
+            return thread, result
+
+        try:
+            if revs:
+                thread, result = fetch(0)
+            for start in xrange(0, len(revs), chunk_size):
+                thread.join()
+                infos, exc_info = result[0]
+                if exc_info:
+                    thread = None
+                    failed = clients
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                if start + chunk_size < len(revs):
+                    thread, result = fetch(start + chunk_size)
+                else:
+                    thread = None
+
+                yield list(self._csets_from_infos(infos))
+                infos = None
+        finally:
+            if thread is not None:
+                thread.join()
+            self._release_clients(clients, failed)
+
+    # The fields Queryset.values() and friends can ask for, with the
+    # template used to output each, and how to convert it
+    _VALUE_FIELDS = { 'rev': ('{rev}', 'int'),
+                      'node': ('{node}', 'text'),
+                      'tags': ('{tags}', 'list'),
+                      'branch': ('{branch}', 'text'),
+                      'author': ('{author}', 'text'),
+                      'desc': ('{desc}', 'text'),
+                      'date': ('{date|hgdate}', 'date'),
+                      'p1rev': ('{p1rev}', 'int'),
+                      'p1node': ('{p1node}', 'text'),
+                      'p2rev': ('{p2rev}', 'int'),
+                      'p2node': ('{p2node}', 'text'),
+                      'phase': ('{phase}', 'text') }
+
+    def _stream_log(self, revset, template, fields):
+        """Run `hg log' for `revset' with `template', which must output
+        `fields' NUL-terminated fields per changeset, yielding a list of the
+        raw fields for each changeset as the output arrives.
+
+        This uses a Client of its own, so you can use the Repository while
+        you iterate."""
+        return self._stream_records(fields, 'log', r=revset,
+                                    template=template)
+
+    def _stream_records(self, fields, cmd_name, *args, **kwargs):
+        """Run `cmd_name', whose output must be NUL-terminated records of
+        `fields' fields each, yielding a list of the raw fields in each
+        record as the output arrives.  Other arguments are as for
+        Client.stream_execute().
+
+        This uses a Client of its own, so you can use the Repository while
+        you iterate."""
+        clients = self._take_clients(1)
+        failed = []
+        stream = None
+        try:
+            stream = clients[0].stream_execute(cmd_name, *args, **kwargs)
+            pending = []
+            tail = ''
+            for chunk in stream:
+                items = (tail + chunk).split('\0')
+                tail = items.pop()
+                if pending:
+                    items = pending + items
+
+                complete = len(items) - len(items) % fields
+                for ndx in xrange(0, complete, fields):
+                    yield items[ndx:ndx+fields]
+
+                pending = items[complete:]
+        except GeneratorExit:
+            raise
+        except BaseException:
+            failed = clients
+            raise
+        finally:
+            # If we were stopped early, the server must finish sending its
+            # output before it can run anything else
+            if stream is not None and not failed:
+                try:
+                    stream.close()
+                except Exception:
+                    failed = clients
+            self._release_clients(clients, failed)
+
+    def _iter_values(self, revset, fields):
+        """Yield a tuple containing the values of `fields' for each
+        changeset in `revset', without creating Changesets."""
+        converters = []
+        template = []
+        for field in fields:
+            spec = Repository._VALUE_FIELDS.get(field)
+            if spec is None:
+                raise KeyError('unknown field %r' % field)
+            template.append(spec[0])
+            converters.append(spec[1])
+        template = '\\0'.join(template) + '\\0'
+
+        encoding = self._client.encoding
+        for raw in self._stream_log(revset, template, len(fields)):
+            values = []
+            for kind, value in itertools.izip(converters, raw):
+                if kind == 'int':
+                    value = int(value)
+                elif kind == 'date':
+                    value = from_hgdate(value)
+                else:
+                    value = value.decode(encoding)
+                    if kind == 'list':
+                        value = value.split()
+                values.append(value)
+            yield tuple(values)
+
+    # The keys Queryset.aggregate() can group by, with the template used to
+    # output each; dates are in each changeset's own time zone
+    _GROUP_FIELDS = { 'author': '{author}',
+                      'person': '{author|person}',
+                      'email': '{author|email}',
+                      'branch': '{branch}',
+                      'phase': '{phase}',
+                      'date:year': '{date(date, "%Y")}',
+                      'date:month': '{date(date, "%Y-%m")}',
+                      'date:day': '{date(date, "%Y-%m-%d")}' }
+
+    _METRICS = ('count', 'files', 'lines_added', 'lines_removed')
+
+    def _aggregate(self, revset, group_by, metrics):
+        """Compute `metrics' for each group of the changesets in `revset',
+        in a single pass over `hg log' output; see Queryset.aggregate()."""
+        if group_by is None:
+            keys = []
+        elif isinstance(group_by, basestring):
+            keys = [group_by]
+        else:
+            keys = list(group_by)
+
+        template = []
+        for key in keys:
+            spec = Repository._GROUP_FIELDS.get(key)
+            if spec is None:
+                raise KeyError('cannot group by %r' % (key,))
+            template.append(spec)
+        for metric in metrics:
+            if metric not in Repository._METRICS:
+                raise KeyError('unknown metric %r' % (metric,))
+
+        # Only ask for a diffstat if we need one; it means reading the
+        # changed files, which is much slower than the rest
+        diffstat = [metric for metric in metrics if metric != 'count']
+        if diffstat:
+            template.append('{diffstat}')
+        elif not template:
+            # We still need a field to count
+            template.append('{rev}')
+        nfields = len(template)
+        template = '\\0'.join(template) + '\\0'
+
+        encoding = self._client.encoding
+        nkeys = len(keys)
+        groups = {}
+        for raw in self._stream_log(revset, template, nfields):
+            key = tuple([value.decode(encoding) for value in raw[:nkeys]])
+            totals = groups.get(key)
+            if totals is None:
+                totals = groups[key] = dict.fromkeys(metrics, 0)
+
+            if 'count' in totals:
+                totals['count'] += 1
+            if diffstat:
+                # e.g. "3: +20/-4"
+                files, lines = raw[nkeys].split(': ', 1)
+                added, removed = lines.split('/', 1)
+                for metric, value in (('files', files),
+                                      ('lines_added', added[1:]),
+                                      ('lines_removed', removed[1:])):
+                    if metric in totals:
+                        totals[metric] += int(value)
+
+        if group_by is None:
+            return groups.get((), dict.fromkeys(metrics, 0))
+        elif isinstance(group_by, basestring):
+            return dict([(group[0], group_totals)
+                         for group, group_totals in groups.iteritems()])
+        return groups
+
+    def _take_clients(self, count):
+        """Take `count' spare Clients from the pool, creating new ones if
+        there aren't enough.  Give them back with _release_clients()."""
+        pool = self._client_pool.clients
+        clients = pool[:count]
+        del pool[:count]
+        while len(clients) < count:
+            clients.append(self._client.copy())
+        return clients
+
+    def _release_clients(self, clients, failed=()):
+        """Return `clients' to the pool.  Any that are also in `failed'
+        raised part way through a command, so may not be ready for
+        another; their servers are shut down instead."""
+        for client in clients:
+            if client in failed:
+                _close_client(client, kill=True)
+            else:
+                self._client_pool.clients.append(client)
+
+    def close(self):
+        """Shut down the command servers this Repository uses, including
+        the spare ones kept for running commands in parallel.  They are
+        started again if you go on using it."""
+        self._client_pool.close()
+        _close_client(self._client)
+
+    def _subrepo(self, path):
+        """Return a Repository for the subrepository at `path' (relative to
+        this repository's root)."""
+        sr = self._subrepos.get(path)
+        if sr is None:
+            sr = self._subrepos[path] = Repository(os.path.join(self._path,
+                                                                path))
+        return sr
+
+    def _run_log(self, changeid, template, parse, extra_args=[], label=None):
+        """Run `hg log' for `changeid' with `template', returning
+        parse(output), which should be a list with an entry per changeset.
+        The command is recorded by any active QueryProfiles under `label',
+        or `changeid' if that isn't given."""
+        if not self._profiles:
+            return parse(self._client.execute('log', *extra_args,
+                                              template=template, r=changeid))
+
+        # Stream the output so that we can tell how long hg took to start
+        # sending it (evaluating the revset) from how long it took to send
+        start = time.time()
+        first = None
+        chunks = []
+        for chunk in self._client.stream_execute('log', *extra_args,
+                                                 template=template,
+                                                 r=changeid):
+            if first is None:
+                first = time.time()
+            chunks.append(chunk)
+        end = time.time()
+        if first is None:
+            first = end
+
+        out = ''.join(chunks)
+        result = parse(out.decode(self._client.encoding))
+        parse_time = time.time() - end
+        for profile in self._profiles:
+            profile._add_command(label or changeid, first - start,
+                                 end - first, len(out), len(result),
+                                 parse_time)
+        return result
+
     def _fetch(self, changeid, extra_args=[]):
-        out = self._client.execute('log', *extra_args,
-                                   template=Repository._TEMPLATE,
-                                   r=changeid).split('\0')
-        return [chunk for chunk in every(out, 12)]
+        return self._run_log(changeid, Repository._TEMPLATE,
+                             lambda out: [chunk for chunk
+                                          in every(out.split('\0'), 12)],
+                             extra_args)
+
+    def _fetch_revs(self, changeid):
+        return self._run_log(changeid, r'{rev}\0',
+                             lambda out: [int(rev) for rev in out.split('\0')
+                                          if rev])
+
+    def _fetch_rev_lists(self, revsets):
+        """Return a list of the revision numbers matched by each of
+        `revsets', using a single `hg log' whose template evaluates all of
+        them with the revset() template function."""
+        template = '\\0'.join(['{revset("%s") %% "{rev} "}'
+                                % _template_escape(revset)
+                                for revset in revsets]) + '\\0'
+        return self._run_log('null', template,
+                             lambda out: [[int(rev) for rev in revs.split()]
+                                          for revs in out.split('\0')[:-1]],
+                             label=' ; '.join(revsets))
 
     def _fetch_one(self, changeid):
         out = self._fetch(changeid, ['-l', '2'])
@@ -468,6 +1386,9 @@ class Repository(BaseRepo):
         out = self._client.execute('list', r=node, recursive=True, all=True,
                                    template=Repository._LIST_TEMPLATE,
                                    binary=True)
+        return self._parse_manifest(out)
+
+    def _parse_manifest(self, out):
         manifest = []
         for rev,node,name in every(out.split('\0'), 3):
             rev = int(rev)
@@ -500,6 +1421,122 @@ class Repository(BaseRepo):
         # This is the cache update mentioned above
         self._update_cache(cset)
 
+    def _fetch_lazy_many(self, csets):
+        """Fetch the information for all the lazy Changesets in `csets' with
+        a single command."""
+        lazy = dict([(cset.rev, cset) for cset in csets if not cset._fetched])
+        if lazy:
+            for info in self._fetch(_intlist(sorted(lazy))):
+                cset = lazy[int(info[0])]
+                cset._init_from_info(info)
+                self._update_cache(cset)
+
+    def _fetch_files(self, csets):
+        """Fetch the lists of files touched by all of `csets' with a single
+        command."""
+        by_rev = dict([(cset.rev, cset) for cset in csets])
+        if not by_rev:
+            return
+        out = self._client.execute('log', r=_intlist(sorted(by_rev)),
+                                   template=Repository._FILES_TEMPLATE)
+        # hg doesn't allow newlines in file names
+        for rev, files in every(out.split('\0'), 2):
+            by_rev[int(rev)]._files = files and files.split('\n') or []
+
+    def _fetch_changes_many(self, csets):
+        """Fetch, parse and cache the changes for all of `csets', using
+        one `hg log --patch' per _PREFETCH_CHUNK changesets."""
+        csets = [cset for cset in csets
+                 if self._cached_changes(cset.node) is None]
+        size = Repository._PREFETCH_CHUNK
+        for start in xrange(0, len(csets), size):
+            revset = _intlist([cset.rev for cset in csets[start:start+size]])
+            out = self._client.execute('log', r=revset, patch=True, git=True,
+                                       template=r'\0{node}\0', binary=True)
+            # Git diffs never contain NULs (binary files are base85
+            # encoded), and log follows each one with a blank line
+            for node, raw in every(out.split('\0')[1:], 2):
+                raw = raw[:-1]
+                self._cache_changes(node, raw,
+                                    list(diffparser.parse(
+                                        raw, lazy=self._lazy_changes)))
+
+    def _fetch_manifests(self, csets, workers):
+        """Fetch the manifests of all of `csets', spreading the work over
+        `workers' command servers."""
+        csets = [cset for cset in csets if cset._manifest is None]
+        if not csets:
+            return
+
+        todo = Queue.Queue()
+        for ndx, cset in enumerate(csets):
+            todo.put((ndx, cset.node))
+
+        clients = self._take_clients(max(1, min(workers, len(csets))))
+        done = Queue.Queue()
+        stop = threading.Event()
+        failed = []
+        threads = []
+        for client in clients:
+            thread = threading.Thread(target=_manifest_worker,
+                                      args=(client, todo, done, stop, failed))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for count in xrange(len(csets)):
+                ndx, out, exc_info = done.get()
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                csets[ndx]._manifest = self._parse_manifest(out)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self._release_clients(clients, failed)
+
+    _PREFETCH_KINDS = ('parents', 'changes', 'files', 'manifest')
+
+    def prefetch(self, csets, *kinds, **kwargs):
+        """Load information for a number of changesets in bulk, rather than
+        running a command per changeset as each is used.
+
+        csets   - the changesets (e.g. a Queryset or a list of Changesets)
+        kinds   - what to load: any of 'parents', 'changes' (as iterating
+                  over a Changeset yields), 'files' and 'manifest'
+        workers - the number of command servers used to list manifests,
+                  which can only be done one changeset at a time
+
+        Changes go into the changes cache, so if you prefetch more than it
+        can hold, the oldest are dropped again; see configure_change_cache().
+        """
+        workers = kwargs.pop('workers', 4)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %r'
+                            % (kwargs.keys(),))
+        for kind in kinds:
+            if kind not in Repository._PREFETCH_KINDS:
+                raise ValueError('cannot prefetch %r' % (kind,))
+
+        csets = [cset if isinstance(cset, Changeset) else self[cset]
+                 for cset in csets]
+        if not csets:
+            return
+
+        if 'parents' in kinds:
+            self._fetch_lazy_many(csets)
+            parents = []
+            for cset in csets:
+                parents.extend(cset.parents)
+            self._fetch_lazy_many(parents)
+        if 'files' in kinds:
+            self._fetch_files([cset for cset in csets if cset._files is None])
+        if 'changes' in kinds:
+            self._fetch_changes_many(csets)
+        if 'manifest' in kinds:
+            self._fetch_manifests(csets, workers)
+
     def __len__(self):
         out = self._client.execute('tip', template='{rev}')
         return int(out) + 1
@@ -584,12 +1621,7 @@ class Repository(BaseRepo):
             
         fmt_query = Repository._PLACEHOLDER_RE.sub(sub_args, query)
 
-        for info in self._fetch(fmt_query):
-            cset = self._live_changesets.get(info[1])
-            if not cset:
-                cset = Changeset(self, info[0], info[1], info)
-                self._live_changesets[info[1]] = cset
-            self._update_cache(cset)
+        for cset in self._query_csets(fmt_query):
             yield cset
 
     def open(self, name, mode='r', rev=None):
@@ -806,7 +1838,7 @@ class Repository(BaseRepo):
 
     def annotate(self, files, rev=None, no_follow=False,
                  text=False, annotations=['changeset'],
-                 include=None, exclude=None):
+                 include=None, exclude=None, incremental=False):
         """Obtain changeset information by line for each file in files.
 
         rev         - annotate the specified revision
@@ -815,6 +1847,8 @@ class Repository(BaseRepo):
         annotations - an iterable containing annotations we want
         include     - include names matching the given pattern(s)
         exclude     - exclude names matching the given pattern(s)
+        incremental - if True, try to derive the annotation from a cached
+                      annotation at the parent revision
 
         Available annotations:
 
@@ -828,10 +1862,19 @@ class Repository(BaseRepo):
         for each line in each file.
 
         In addition, if you specify `user', you can obtain the short username
-        by asking for the short_user property of the yielded line."""
+        by asking for the short_user property of the yielded line.
+
+        Unless `include' or `exclude' is given, annotations are cached by
+        file revision, so annotating a file that has not changed since the
+        last time you asked is cheap.
+
+        With `incremental' set, if a file was modified by `rev' (which must
+        not be a merge) and we have its annotation at the parent revision
+        cached, we apply the changeset's diff to that annotation rather than
+        asking hg to annotate the whole file again.  Renames, copies and
+        binary changes fall back to a full annotate."""
         
         # Normalise the input
-        files = self._map_files(files)
         rev = self._map_one_rev(rev)
 
         # Select annotations
@@ -852,65 +1895,174 @@ class Repository(BaseRepo):
         if not user and not date and not file and not line and not changeset:
             raise ValueError('you probably want to specify some annotations')
 
-        # Get the output
+        if include or exclude:
+            annotated = self._annotate_files(self._map_files(files), rev,
+                                             no_follow, text, include, exclude)
+        else:
+            annotated = self._annotate_cached(files, rev, no_follow, text,
+                                              incremental)
+
+        for path, lines in annotated:
+            for l in lines:
+                yield l
+
+    def _file_nodes(self, files, rev, eh=None):
+        """Return a list of (path, node) tuples giving, for each file, the
+        node of the changeset that last changed it as of `rev'.  This
+        identifies the file revision."""
+        out = self._client.execute('list', self._map_files(files),
+                                   r=rev or '.', recursive=True, all=True,
+                                   template=Repository._LIST_TEMPLATE,
+                                   binary=True, eh=eh)
+        if not out:
+            return []
+
+        encoding = self._client.encoding
+        result = []
+        for linkrev, node, name in every(out.split('\0'), 3):
+            if int(linkrev) != -1:
+                result.append((name.decode(encoding), node))
+        return result
+
+    def _annotate_cached(self, files, rev, no_follow, text, incremental):
+        """Annotate files, re-using cached annotations for any file revisions
+        we have already seen.  Yields (path, lines) tuples."""
+        # Find out which revision of each file we're dealing with
+        keys = []
+        missing = []
+        for path, node in self._file_nodes(files, rev):
+            key = (path, node, no_follow, text)
+            keys.append(key)
+            if key not in self._annotate_cache:
+                missing.append(path)
+
+        fresh = {}
+        nodes = dict([file_key[:2] for file_key in keys])
+
+        if missing and incremental:
+            for path, lines in self._annotate_incremental(missing, rev, nodes,
+                                                          no_follow, text):
+                fresh[path] = lines
+                self._annotate_cache[(path, nodes[path],
+                                      no_follow, text)] = lines
+            missing = [path for path in missing if path not in fresh]
+            
+        if missing:
+            for path, lines in self._annotate_files(self._map_files(missing),
+                                                    rev, no_follow, text):
+                fresh[path] = lines
+                self._annotate_cache[(path, nodes[path],
+                                      no_follow, text)] = lines
+
+        for key in keys:
+            lines = fresh.get(key[0])
+            if lines is None:
+                lines = self._annotate_cache[key]
+            if lines is not None:
+                yield (key[0], lines)
+
+    def _annotate_incremental(self, paths, rev, nodes, no_follow, text):
+        """Try to build annotations for `paths' at `rev' by patching cached
+        annotations from the parent revision.  Returns a list of (path, lines)
+        tuples for the files we were able to do."""
+        cset = self[rev or '.']
+        if cset is None or len(cset.parents) != 1:
+            return []
+
+        # Only files changed by this changeset can be derived from the parent
+        paths = [path for path in paths if nodes[path] == cset.node]
+        if not paths:
+            return []
+
+        parent_nodes = dict(self._file_nodes(paths, cset.parents[0].node,
+                                             eh=lambda *args: ''))
+
+        encoding = self._client.encoding
+        changes = {}
+        for change in self._fetch_changes(cset):
+            dest = change.dest
+            if isinstance(dest, str):
+                dest = dest.decode(encoding)
+            changes[dest] = change
+
+        result = []
+        for path in paths:
+            node = parent_nodes.get(path)
+            change = changes.get(path)
+            if node is None or change is None or type(change) is not Change \
+                   or change.source != change.dest:
+                continue
+
+            old = self._annotate_cache[(path, node, no_follow, text)]
+            if old is None:
+                continue
+
+            def new_line(lineno, line):
+                l = AnnotatedString(_strip_eol(line.decode(encoding)))
+                l.user = cset.author
+                l.changeset = cset
+                l.date = cset.date
+                l.file = path
+                l.line = lineno
+                return l
+
+            lines = _patch_annotation(old, change.hunks, new_line)
+            if lines is not None:
+                result.append((path, lines))
+
+        return result
+
+    def _annotate_files(self, files, rev, no_follow, text,
+                        include=None, exclude=None):
+        """Run annotate, returning a list of (path, lines) tuples, where
+        lines is a list of AnnotatedStrings with all annotations set."""
         out = self._client.execute('annotate', files,
                                    r=rev, no_follow=no_follow,
-                                   a=text, u=user, f=file, d=date,
-                                   n=changeset, c=changeset,
-                                   l=line,
+                                   a=text, u=True, f=True, d=True,
+                                   n=True, c=True, l=True,
                                    I=include, X=exclude,
-                                   debug=True)
-
-        # Build a regex to match the annotations
-        regex = [r'^\s*']
-        if user:
-            regex.append(r'(?P<user>[A-Za-z_][A-Za-z0-9_-]*|\w[\w\s]*\s<[^>]+>)\s*')
-        if changeset:
-            regex.append(r'(?P<changeset>\d+ [A-Fa-f0-9]{40})\s*')
-        if date:
-            regex.append(r'(?P<date>(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun) '
-                         r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Dec) '
-                         r'\d+ \d+:\d+:\d+ \d+ [+-]?\d+)\s*')
-        if file:
-            regex.append(r'(?P<file>[^/\\]+)')
-        if line:
-            regex.append(r':(?P<line>\d+)')
-        regex.append(r'$')
-        regex = ''.join(regex)
-        regex = re.compile(regex)
-
-        # For each line, parse the annotations and stuff them onto an
-        # AnnotatedString containing the line's text
-        for l in out.splitlines():
-            info, text = l.split(': ', 1)
-            m = regex.match(info)
-            
-            out = AnnotatedString(text)
-            if user:
-                out.user = m.group('user')
-            if changeset:
-                rev, node = m.group('changeset').split(' ', 1)
-                rev = int(rev)
-                out.changeset = self._get_lazy(rev, node)
-            if date:
-                the_date,offset = m.group('date').rsplit(' ', 1)
-                the_date = datetime.datetime.strptime(the_date,
-                                                      '%a %b %d %H:%M:%S %Y')
-                ofs = int(offset[:-2]) * 60
-                was_negative = offset < 0
-                if was_negative:
-                    ofs = -ofs
-                ofs += int(offset[-2:])
-                if was_negative:
-                    ofs = -ofs
-                tzinfo = SimpleTzInfo(ofs)
-                out.date = the_date.replace(tzinfo=tzinfo)
-            if file:
-                out.file = m.group('file')
-            if line:
-                out.line = int(m.group('line'))
+                                   template=Repository._ANNOTATE_TEMPLATE)
+
+        # The output is a sequence of NUL-separated fields; for each file,
+        # we get the path, the number of lines, then seven fields per line.
+        # We parse a column at a time, sharing Changeset and date objects.
+        fields = out.split('\0')
+        csets = {}
+        dates = {}
+        result = []
+        ndx = 0
+        while ndx + 1 < len(fields):
+            path = fields[ndx]
+            start = ndx + 2
+            ndx = start + 7 * int(fields[ndx + 1])
+            block = fields[start:ndx]
+
+            nodes = block[1::7]
+            for rev, node in itertools.izip(block[0::7], nodes):
+                if node not in csets:
+                    csets[node] = self._get_lazy(int(rev), node)
+
+            hgdates = block[3::7]
+            for hgdate in hgdates:
+                if hgdate not in dates:
+                    dates[hgdate] = from_hgdate(hgdate)
+
+            lines = []
+            for text, user, hgdate, source, lineno, node \
+                    in itertools.izip(block[6::7], block[2::7], hgdates,
+                                      block[4::7], map(int, block[5::7]),
+                                      nodes):
+                l = AnnotatedString(_strip_eol(text))
+                l.user = user
+                l.changeset = csets[node]
+                l.date = dates[hgdate]
+                l.file = source
+                l.line = lineno
+                lines.append(l)
+
+            result.append((path, lines))
 
-            yield out
+        return result
             
     def archive(self, dest, rev=None, no_decode=False, prefix=None, type=None,
                 subrepos=False, include=None, exclude=None):
@@ -1046,6 +2198,11 @@ class Repository(BaseRepo):
 
            active    - the currently active bookmark, or None
            bookmarks - a dictionary mapping bookmark names to Changesets"""
+        active, bookmarks = self._cached_metadata('bookmarks', 'bookmarks',
+                                                  self._fetch_bookmarks)
+        return (active, dict(bookmarks))
+
+    def _fetch_bookmarks(self):
         out = self._client.execute('bookmarks', debug=True)
         bookmarks = {}
         active = None
@@ -1087,7 +2244,12 @@ class Repository(BaseRepo):
 
         active - return only branches that have unmerged heads
         closed - return normal and closed branches"""
-        
+        return dict(self._cached_metadata('branches',
+                                          ('branches', active, closed),
+                                          lambda: self._fetch_branches(active,
+                                                                       closed)))
+
+    def _fetch_branches(self, active, closed):
         out = self._client.execute('branches', a=active, c=closed,
                                    debug=True)
         branches = {}
@@ -1292,7 +2454,7 @@ class Repository(BaseRepo):
     def changes(self, files=[], rev=None, change=None, text=False,
                 reverse=False, ignore_all_space=False, ignore_space_change=False,
                 ignore_blank_lines=False, context=None, subrepos=False,
-                include=None, exclude=None):
+                include=None, exclude=None, lazy=False):
         """Generate Change objects between revisions for the specified files.
 
         files         -  the files to diff (if None, diff the entire repository)
@@ -1312,6 +2474,8 @@ class Repository(BaseRepo):
         include       -  include names matching the given patterns
         exclude       -  exclude names matching the given patterns
         subrepos      -  recurse into subrepositories
+        lazy          -  only split up hunk lines when they are used; see
+                         diffparser.parse()
 
         Returns a generator that yields Change objects."""   
         return diffparser.parse(self.diff(files=files, rev=rev, change=change,
@@ -1320,7 +2484,83 @@ class Repository(BaseRepo):
                                           ignore_space_change=ignore_space_change,
                                           ignore_blank_lines=ignore_blank_lines,
                                           unified=context, subrepos=subrepos,
-                                          include=include, exclude=exclude))
+                                          include=include, exclude=exclude),
+                                lazy=lazy)
+
+    def changes_many(self, csets, workers=4, ordered=False):
+        """Generate Change objects for each of a number of changesets,
+        spreading the work over several Mercurial command servers.
+
+        csets   - the changesets (e.g. a Queryset or a list of Changesets)
+        workers - the number of command servers to use in parallel
+        ordered - if True, yield results in the same order as csets;
+                  otherwise, yield them as soon as they are available
+
+        Yields (changeset, changes) tuples, where changes is a list of Change
+        objects.  The results are also added to the changes cache, so that
+        iterating over the Changesets afterwards is cheap."""
+        csets = [cset if isinstance(cset, Changeset) else self[cset]
+                 for cset in csets]
+
+        results = {}
+        todo = Queue.Queue()
+        for ndx, cset in enumerate(csets):
+            changes = self._cached_changes(cset.node)
+            if changes is not None:
+                results[ndx] = changes
+            else:
+                todo.put((ndx, cset.node))
+
+        pending = todo.qsize()
+        next_ndx = 0
+        
+        if not ordered:
+            for ndx in sorted(results):
+                yield (csets[ndx], results.pop(ndx))
+        
+        if pending:
+            clients = self._take_clients(max(1, min(workers, pending)))
+        else:
+            clients = []
+
+        done = Queue.Queue()
+        stop = threading.Event()
+        failed = []
+        threads = []
+        for client in clients:
+            thread = threading.Thread(target=_diff_worker,
+                                      args=(client, todo, done, stop,
+                                            self._lazy_changes, failed))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while True:
+                if ordered:
+                    while next_ndx in results:
+                        yield (csets[next_ndx], results.pop(next_ndx))
+                        next_ndx += 1
+
+                if not pending:
+                    break
+
+                ndx, raw, changes, exc_info = done.get()
+                pending -= 1
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                self._cache_changes(csets[ndx].node, raw, changes)
+
+                if ordered:
+                    results[ndx] = changes
+                else:
+                    yield (csets[ndx], changes)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self._release_clients(clients, failed)
 
     def diff(self, files=[], rev=None, change=None, text=False,
              git=False, nodates=False, show_function=False, reverse=False,
@@ -1517,55 +2757,51 @@ class Repository(BaseRepo):
            and not type_ and not match_text:
             raise ValueError('you probably want either some annotations or the match text')
 
-        out = self._client.execute('grep', pattern, files,
-                                   r=rev, f=not no_follow,
-                                   a=text, i=ignore_case,
-                                   l=not match_text,
-                                   n=line, u=user, d=date,
-                                   I=include, X=exclude,
-                                   v=True,
-                                   print0=True)
-
+        # Fields come in the order hg prints them: file, rev, line, type,
+        # user, date and then the matched text
         fields = 2 # filename rev
-        if user:
-            fields += 1
-        if date:
-            fields += 1
         if line:
+            line_ndx = fields
             fields += 1
         if type_:
+            type_ndx = fields
+            fields += 1
+        if user:
+            user_ndx = fields
+            fields += 1
+        if date:
+            date_ndx = fields
             fields += 1
         if match_text:
             fields += 1
-            
-        for l in every(out.split('\0'), fields):
+
+        encoding = self._client.encoding
+        for l in self._stream_records(fields, 'grep', pattern, files,
+                                      r=rev, f=not no_follow,
+                                      a=text, i=ignore_case,
+                                      l=not match_text,
+                                      n=line, u=user, d=date,
+                                      I=include, X=exclude,
+                                      all=type_,
+                                      v=True,
+                                      print0=True,
+                                      eh=SimpleErrorHandler()):
             if match_text:
-                out = GrepString(l[-1])
+                out = GrepString(l[-1].decode(encoding))
             else:
                 out = GrepResult()
 
-            out.file = l.pop(0)
-            out.rev = int(l.pop(0))
+            out.file = l[0].decode(encoding)
+            out.rev = int(l[1])
 
             if line:
-                out.line = int(l.pop(0))
+                out.line = int(l[line_ndx])
             if type_:
-                out.type = l.pop(0)
+                out.type = l[type_ndx]
             if user:
-                out.user = l.pop(0)
+                out.user = l[user_ndx].decode(encoding)
             if date:
-                the_date,offset = l.pop(0).rsplit(' ', 1)
-                the_date = datetime.datetime.strptime(the_date,
-                                                      '%a %b %d %H:%M:%S %Y')
-                ofs = int(offset[:-2]) * 60
-                was_negative = offset < 0
-                if was_negative:
-                    ofs = -ofs
-                ofs += int(offset[-2:])
-                if was_negative:
-                    ofs = -ofs
-                tzinfo = SimpleTzInfo(ofs)
-                out.date = the_date.replace(tzinfo=tzinfo)
+                out.date = from_datestr(l[date_ndx])
 
             yield out
 
@@ -1723,7 +2959,7 @@ class Repository(BaseRepo):
 
     def ls(self, patterns=[], rev=None, all=False, sort=['name'],
            fields=['mode', 'user', 'size', 'rev', 'date', 'name'],
-           subrepos=False, links=False, recursive=False):
+           subrepos=False, links=False, recursive=False, columnar=False):
         """List matching files in the repository.
 
         For each name given that is a file of a type other than a directory,
@@ -1774,7 +3010,12 @@ class Repository(BaseRepo):
           linktype      the type of a subrepository link
           
         For each matching file, this method will generate a tuple containing
-        one item for each item in the "fields" argument."""
+        one item for each item in the "fields" argument.
+
+        If "columnar" is True, this method instead returns a FileListing
+        holding one column per field.  This is much cheaper for very large
+        listings, because Changeset and datetime objects are created lazily
+        and numeric fields are stored in arrays."""
         rev = self._map_one_rev(rev)
 
         sort = ','.join(sort)
@@ -1785,7 +3026,7 @@ class Repository(BaseRepo):
                      'kind': '{kind}',
                      'subrepo': '{subrepo}',
                      'rev': '{subrepo}:{rev}:{node}',
-                     'date': '{date}',
+                     'date': '{date|hgdate}',
                      'author': '{author}',
                      'user': '{author|user}',
                      'branch': '{branch}',
@@ -1794,9 +3035,13 @@ class Repository(BaseRepo):
                      'linkrev': '{linkrev}',
                      'linktype': '{linktype}' }
 
+        if columnar:
+            # Split out the parts of 'rev' so we can slice them as columns
+            fieldmap['rev'] = r'{subrepo}\0{rev}\0{node}'
+            
         try:
             template = [fieldmap[f] for f in fields]
-        except IndexError:
+        except KeyError:
             raise BadFieldError('bad field in fields specification')
         
         template = r'\0'.join(template + [''])
@@ -1809,8 +3054,49 @@ class Repository(BaseRepo):
                                    recursive=recursive,
                                    binary=True)
 
-        subreps = {}
-        
+        if columnar:
+            return self._ls_columns(out, fields)
+        return self._ls_rows(out, fields)
+
+    def _ls_columns(self, out, fields):
+        """Build a FileListing from the output of the list command."""
+        items = out.split('\0')
+        width = len(fields)
+        if 'rev' in fields:
+            width += 2
+        count = len(items) // width
+        end = count * width
+        encoding = self._client.encoding
+
+        columns = {}
+        nodes = subrepos = offsets = None
+        ndx = 0
+        for field in fields:
+            if field == 'rev':
+                subrepos = items[ndx:end:width]
+                columns['rev'] = array.array('l', map(int,
+                                                      items[ndx+1:end:width]))
+                nodes = items[ndx+2:end:width]
+                ndx += 3
+                continue
+            
+            column = items[ndx:end:width]
+            if field in ('mode', 'size'):
+                column = array.array('l', map(int, column))
+            elif field == 'date':
+                parts = ' '.join(column).split(' ')
+                column = array.array('d', map(float, parts[0::2]))
+                offsets = array.array('l', [-int(ofs) // 60
+                                            for ofs in parts[1::2]])
+            elif field != 'name':
+                column = [item.decode(encoding) for item in column]
+            columns[field] = column
+            ndx += 1
+
+        return FileListing(self, fields, columns, nodes, subrepos, offsets)
+
+    def _ls_rows(self, out, fields):
+        """Yield tuples from the output of the list command."""
         for t in every(out.split('\0'), len(fields)):
             result = []
             for item,field in itertools.izip(t, fields):
@@ -1822,16 +3108,11 @@ class Repository(BaseRepo):
                     if r == -1:
                         result.append(None)
                     elif s:
-                        sr = subreps.get(s, None)
-                        if sr is None:
-                            sr = Repository(os.path.join(self._path, s))
-                            subreps[s] = sr
-                        result.append(sr._get_lazy(r, n))
+                        result.append(self._subrepo(s)._get_lazy(r, n))
                     else:
                         result.append(self._get_lazy(r, n))
                 elif field == 'date':
-                    utc = float(item.split('.', 1)[0])
-                    result.append(datetime_from_timestamp(utc))
+                    result.append(from_hgdate(item))
                 elif field != 'name':
                     result.append(item.decode(self._client.encoding))
                 else:
@@ -1915,6 +3196,13 @@ class Repository(BaseRepo):
 
         With one or more arguments of the form <section>, retrieve just
         those sections as a dictionary."""
+        result = self._cached_metadata('config', ('config',) + args,
+                                       lambda: self._fetch_config(args))
+        if isinstance(result, dict):
+            result = copy.deepcopy(result)
+        return result
+
+    def _fetch_config(self, args):
         if len(args) == 1 and args[0].find('.') >= 0:
             return self._client.execute('showconfig', args[0]).strip()
         
@@ -1936,6 +3224,13 @@ class Repository(BaseRepo):
 
         If `name' is specified, returns just the specified path, or None if
         it is not found."""
+        result = self._cached_metadata('paths', ('paths', name),
+                                       lambda: self._fetch_paths(name))
+        if isinstance(result, dict):
+            result = dict(result)
+        return result
+
+    def _fetch_paths(self, name):
         eh = SimpleErrorHandler()
         
         out = self._client.execute('paths', name, eh=eh)
@@ -1947,7 +3242,7 @@ class Repository(BaseRepo):
         
         result = {}
         for line in out.splitlines():
-            name, path = out.split(' = ', 1)
+            name, path = line.split(' = ', 1)
             result[name] = path.strip()
             
         return result
@@ -2236,24 +3531,7 @@ class Repository(BaseRepo):
                                    I=include, X=exclude,
                                    S=subrepos, print0=True)
 
-        result = []
-        for entry in out.split('\0'):
-            if entry:
-                if entry[0] == ' ':
-                    result.append((Repository.ORIGINAL, entry[2:]))
-                else:
-                    status_map = { 'M': 'modified',
-                                   'A': 'added',
-                                   'R': 'removed',
-                                   'C': 'clean',
-                                   '!': 'missing',
-                                   '?': 'untracked',
-                                   'I': 'ignored',
-                                   ' ': 'original' }
-                    status, name = entry.split(' ', 1)
-                    result.append((status_map[status], name))
-                    
-        return result
+        return _parse_status(out)
     
     def summary(self, remote=False):
         """Return a dictionary containing a summary of the working directory
@@ -2456,6 +3734,9 @@ class Repository(BaseRepo):
     
     def tags(self):
         """Return a list of repository tags as (name, changeset, is_local)"""
+        return list(self._cached_metadata('tags', 'tags', self._fetch_tags))
+
+    def _fetch_tags(self):
         out = self._client.execute('tags', v=True, debug=True)
 
         result = []
@@ -0,0 +1,292 @@
+"""Revset syntax trees.
+
+Querysets describe their revsets as trees of tuples, much like the ones
+Mercurial's own revset parser builds:
+
+  ('all',)                        all()
+  ('none',)                       none()
+  ('symbol', text)                text, verbatim (a number, a node...)
+  ('string', text)                text, already quoted
+  ('func', name, arg, ...)        name(arg, ...)
+  ('and', x, y, ...)              x and y and ...
+  ('or', x, y, ...)               x or y or ...
+  ('not', x)                      not x
+  ('minus', x, y)                 x - y
+  ('range', x, y)                 x:y (either may be None)
+  ('dagrange', x, y)              x::y (either may be None)
+  ('parent', x, n)                x^n
+
+Trees are immutable, so subtrees are shared freely between querysets.
+optimize() rewrites a tree into a cheaper equivalent and render() turns it
+into a string for hg."""
+
+ALL = ('all',)
+NONE = ('none',)
+
+def quote(value):
+    """Return `value' as a quoted revset string."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '\'%s\'' % value.replace('\'', '\\\'')
+
+def string(value):
+    return ('string', quote(value))
+
+def symbol(text):
+    return ('symbol', text)
+
+def func(name, *args):
+    return ('func', name) + args
+
+def and_(*terms):
+    return ('and',) + terms
+
+def or_(*terms):
+    return ('or',) + terms
+
+def not_(tree):
+    return ('not', tree)
+
+# Rendering
+
+_LEAVES = frozenset(('all', 'none', 'symbol', 'string', 'func'))
+
+def render(tree):
+    """Return the revset string for `tree'."""
+    out = []
+    _render(tree, out)
+    return ''.join(out)
+
+def _operand(tree, out):
+    if tree[0] in _LEAVES:
+        _render(tree, out)
+    else:
+        out.append('(')
+        _render(tree, out)
+        out.append(')')
+
+def _render(tree, out):
+    op = tree[0]
+    if op == 'all':
+        out.append('all()')
+    elif op == 'none':
+        out.append('none()')
+    elif op == 'symbol' or op == 'string':
+        out.append(tree[1])
+    elif op == 'func':
+        out.append(tree[1])
+        out.append('(')
+        for ndx, arg in enumerate(tree[2:]):
+            if ndx:
+                out.append(', ')
+            _render(arg, out)
+        out.append(')')
+    elif op == 'and' or op == 'or':
+        sep = ' %s ' % op
+        for ndx, term in enumerate(tree[1:]):
+            if ndx:
+                out.append(sep)
+            if term[0] == 'not':
+                _render(term, out)
+            else:
+                _operand(term, out)
+    elif op == 'not':
+        out.append('not ')
+        _operand(tree[1], out)
+    elif op == 'minus':
+        _operand(tree[1], out)
+        out.append(' - ')
+        _operand(tree[2], out)
+    elif op == 'range' or op == 'dagrange':
+        if tree[1] is not None:
+            _operand(tree[1], out)
+        out.append(op == 'range' and ':' or '::')
+        if tree[2] is not None:
+            _operand(tree[2], out)
+    elif op == 'parent':
+        _operand(tree[1], out)
+        out.append('^%d' % tree[2])
+    else:
+        raise ValueError('unknown revset node %r' % (op,))
+
+# Optimization
+
+# Functions whose results are in ascending revision order, whatever order
+# their arguments are in.  Anything not listed is assumed to have an
+# order of its own (e.g. reverse(), sort(), first()), which `and' and `-'
+# preserve from their first operand, so we must not move it about.
+_ASCENDING_FUNCS = frozenset((
+    'adds', 'all', 'ancestor', 'ancestors', 'author', 'bisect', 'bookmark',
+    'branch', 'branchpoint', 'bumped', 'children', 'closed', 'contains',
+    'converted', 'date', 'desc', 'descendants', 'destination', 'draft',
+    'extinct', 'extra', 'file', 'filelog', 'follow', 'grep', 'head', 'heads',
+    'hidden', 'id', 'keyword', 'max', 'merge', 'min', 'modifies', 'node',
+    'none', 'obsolete', 'origin', 'outgoing', 'p1', 'p2', 'parents', 'public',
+    'removes', 'rev', 'roots', 'secret', 'tag', 'transplanted',
+    'unstable', 'user'))
+
+# Rough relative costs of evaluating each function over a set, in the
+# spirit of the weights Mercurial's own optimizer uses
+_COSTS = {
+    'rev': 0.1, 'node': 0.1, 'id': 0.1, 'tag': 0.5,
+    'bookmark': 0.5, 'public': 0.5, 'draft': 0.5, 'secret': 0.5,
+    'head': 0.5, 'max': 0.5, 'min': 0.5, 'p1': 1, 'p2': 1, 'parents': 1,
+    'branch': 1, 'merge': 1, 'closed': 1, 'date': 1, 'user': 1,
+    'author': 1, 'desc': 1, 'extra': 1, 'children': 2, 'heads': 2,
+    'roots': 2, 'ancestors': 2, 'descendants': 2, 'ancestor': 2,
+    'branchpoint': 2, 'keyword': 10, 'adds': 30, 'modifies': 30,
+    'removes': 30, 'file': 30, 'filelog': 30, 'follow': 30,
+    'contains': 100, 'grep': 100 }
+
+def cost(tree):
+    """Return the estimated relative cost of evaluating `tree'."""
+    op = tree[0]
+    if op in ('all', 'none', 'symbol', 'string'):
+        return 0
+    elif op == 'func':
+        return _COSTS.get(tree[1], 1) + sum([cost(arg) for arg in tree[2:]])
+    elif op == 'parent':
+        return 1 + cost(tree[1])
+    else:
+        return 1 + sum([cost(arg) for arg in tree[1:] if arg is not None])
+
+def _revnum(tree):
+    """Return the revision number `tree' names, or None."""
+    if tree is not None and tree[0] == 'symbol' and tree[1].isdigit():
+        return int(tree[1])
+    return None
+
+def is_ascending(tree):
+    """Return True if the result of `tree' is always in ascending order."""
+    op = tree[0]
+    if op in ('all', 'none', 'not', 'dagrange'):
+        return True
+    elif op == 'func':
+        return tree[1] in _ASCENDING_FUNCS
+    elif op == 'and' or op == 'minus':
+        return is_ascending(tree[1])
+    elif op == 'range':
+        start, end = _revnum(tree[1]), _revnum(tree[2])
+        return start is not None and end is not None and start <= end
+    return False
+
+def optimize(tree, memo=None):
+    """Return a tree equivalent to `tree', including in the order of its
+    results, that should be cheaper for hg to evaluate.
+
+    `memo' may map the id()s of subtrees to their already optimized
+    forms, which are used as they are."""
+    if memo:
+        result = memo.get(id(tree))
+        if result is not None:
+            return result
+
+    op = tree[0]
+    if op == 'and':
+        return _optimize_and([optimize(term, memo) for term in tree[1:]])
+    elif op == 'or':
+        return _optimize_or([optimize(term, memo) for term in tree[1:]])
+    elif op == 'not':
+        arg = optimize(tree[1], memo)
+        if arg == ALL:
+            return NONE
+        elif arg == NONE:
+            return ALL
+        elif arg[0] == 'not' and is_ascending(arg[1]):
+            return arg[1]
+        return ('not', arg)
+    elif op == 'minus':
+        lhs, rhs = optimize(tree[1], memo), optimize(tree[2], memo)
+        if lhs == NONE or lhs == rhs:
+            return NONE
+        elif rhs == NONE:
+            return lhs
+        return ('minus', lhs, rhs)
+    elif op == 'func':
+        return tree[:2] + tuple([optimize(arg, memo) for arg in tree[2:]])
+    elif op == 'range' or op == 'dagrange':
+        return (op,) + tuple([arg is not None and optimize(arg, memo) or None
+                              for arg in tree[1:]])
+    elif op == 'parent':
+        return ('parent', optimize(tree[1], memo), tree[2])
+    return tree
+
+def _flatten(op, terms):
+    """Flatten nested `op' nodes and drop duplicate terms, keeping the
+    first of each."""
+    result = []
+    seen = set()
+    for term in terms:
+        if term[0] == op:
+            subterms = term[1:]
+        else:
+            subterms = (term,)
+        for subterm in subterms:
+            if subterm not in seen:
+                seen.add(subterm)
+                result.append(subterm)
+    return result
+
+def _fold_ranges(terms):
+    """Intersect any ascending constant revision ranges in `terms'."""
+    first = None
+    lo = hi = None
+    result = []
+    for term in terms:
+        if term[0] == 'range' and is_ascending(term):
+            start, end = _revnum(term[1]), _revnum(term[2])
+            if first is None:
+                first = len(result)
+                lo, hi = start, end
+                result.append(None)
+            else:
+                lo, hi = max(lo, start), min(hi, end)
+        else:
+            result.append(term)
+
+    if first is not None:
+        if lo > hi:
+            return [NONE]
+        elif lo == hi:
+            result[first] = func('rev', symbol(str(lo)))
+        else:
+            result[first] = ('range', symbol(str(lo)), symbol(str(hi)))
+    return result
+
+def _optimize_and(terms):
+    terms = _flatten('and', terms)
+    if NONE in terms:
+        return NONE
+
+    terms = _fold_ranges(terms)
+    if NONE in terms:
+        return NONE
+
+    # all() is a no-op, except that in first place it sorts the result
+    leading_all = terms[0] == ALL
+    terms = [term for term in terms if term != ALL]
+    if not terms:
+        return ALL
+    if leading_all and not is_ascending(terms[0]):
+        terms.insert(0, ALL)
+
+    # The result is ordered by the first term, so if that's in ascending
+    # order, we can put any other ascending term first; the remaining
+    # terms only filter, so their order doesn't matter.  Cheap filters
+    # first means fewer revisions reach the expensive ones.
+    if is_ascending(terms[0]):
+        terms.sort(key=lambda term: (not is_ascending(term), cost(term)))
+    else:
+        terms[1:] = sorted(terms[1:], key=cost)
+
+    if len(terms) == 1:
+        return terms[0]
+    return ('and',) + tuple(terms)
+
+def _optimize_or(terms):
+    terms = [term for term in _flatten('or', terms) if term != NONE]
+    if not terms:
+        return NONE
+    elif len(terms) == 1:
+        return terms[0]
+    return ('or',) + tuple(terms)
@@ -0,0 +1,294 @@
+import os
+import os.path
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from mercury.exceptions import *
+from mercury.repo import _parse_status
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0x00080000
+IN_NONBLOCK    = 0x00000800
+
+_TREE_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM \
+             | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF \
+             | IN_MOVE_SELF | IN_ONLYDIR
+_HG_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+_EVENT = struct.Struct('iIII')
+
+class _Inotify(object):
+    """A minimal ctypes wrapper around Linux's inotify API."""
+    _libc = None
+
+    def __init__(self):
+        libc = _Inotify._load()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise WatcherError('unable to initialise inotify: %s'
+                               % os.strerror(err))
+
+    @classmethod
+    def _load(cls):
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c')
+                                   or 'libc.so.6', use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+            except (OSError, AttributeError):
+                raise WatcherError('inotify is not available on this platform')
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                               ctypes.c_uint32]
+            cls._libc = libc
+        return cls._libc
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self):
+        """Return a list of (wd, mask, name) tuples for all pending events."""
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        data = ''.join(chunks)
+        events = []
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            events.append((wd, mask, data[pos:pos+length].rstrip('\0')))
+            pos += length
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class StatusWatcher(object):
+    """Keeps a cached copy of the status of a Repository's working directory,
+    using Linux's inotify to find out which paths might have changed.
+
+    The first call to status() runs a full `hg status'; after that, only the
+    paths that inotify has reported as touched are re-examined, so repeated
+    calls are very cheap when little has changed.  Anything that changes the
+    dirstate (a commit, update, add and so on) or .hgignore, or an inotify
+    queue overflow, causes a full refresh.
+
+    Keyword arguments select what to report, as for Repository.status():
+    all, modified, added, removed, deleted, clean, unknown, ignored and
+    subrepos.
+
+    The watcher runs its own command server; call close() (or use it as a
+    context manager) when you're done with it."""
+
+    _SWITCHES = { 'all': 'A', 'modified': 'm', 'added': 'a', 'removed': 'r',
+                  'deleted': 'd', 'clean': 'c', 'unknown': 'u',
+                  'ignored': 'i', 'subrepos': 'S' }
+
+    _ORDER = { 'modified': 0, 'added': 1, 'removed': 2, 'missing': 3,
+               'untracked': 4, 'ignored': 5, 'clean': 6 }
+
+    # Past this many dirty paths, a full status is cheaper
+    _MAX_DIRTY = 1000
+
+    def __init__(self, repo, **flags):
+        self._switches = {}
+        for flag, value in flags.iteritems():
+            switch = StatusWatcher._SWITCHES.get(flag)
+            if switch is None:
+                raise TypeError('unexpected keyword argument %r' % flag)
+            self._switches[switch] = value
+
+        self._root = os.path.abspath(repo.path)
+        if isinstance(self._root, unicode):
+            self._root = self._root.encode('utf-8')
+
+        # Run in the repository root, so that the paths hg gives us back
+        # are relative to it even when we pass explicit files
+        self._client = repo._client.copy(cwd=self._root)
+
+        self._status = {}
+        self._dirty = set()
+        self._full = True
+        self._degraded = False
+
+        self._inotify = _Inotify()
+        self._dirs = {}
+        self._hg_wd = self._inotify.add_watch(os.path.join(self._root, '.hg'),
+                                              _HG_MASK)
+        self._watch_tree('')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Stop watching and shut down the command server."""
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        if self._client._server is not None:
+            self._client.disconnect()
+
+    def refresh(self):
+        """Force a full refresh the next time status() is called."""
+        self._full = True
+
+    def status(self):
+        """Return the status of files in the working directory as a list of
+        (<status>, <path>) pairs, in the same form as Repository.status()."""
+        self._process_events()
+
+        if self._full or self._degraded \
+               or len(self._dirty) > StatusWatcher._MAX_DIRTY:
+            self._refresh_all()
+        elif self._dirty:
+            self._refresh_paths(self._dirty)
+
+        order = StatusWatcher._ORDER
+        return sorted([(status, path)
+                       for path, status in self._status.iteritems()],
+                      key=lambda (status, path): (order.get(status), path))
+
+    def _watch_tree(self, top):
+        """Add watches for `top' (relative to the root) and everything
+        beneath it, apart from .hg directories."""
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self._root,
+                                                                 top)):
+            if '.hg' in dirnames:
+                dirnames.remove('.hg')
+            try:
+                wd = self._inotify.add_watch(dirpath, _TREE_MASK)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                # Most likely we've run out of watches; we can still give
+                # correct answers, just not quickly.
+                self._degraded = True
+                return
+            self._dirs[wd] = os.path.relpath(dirpath, self._root)
+
+    def _process_events(self, ignore_dirstate=False):
+        """Note which paths the pending events touch.  Returns True if any
+        were for the dirstate and `ignore_dirstate' told us to skip them."""
+        encoding = self._client.encoding
+        ignored = False
+        for wd, mask, name in self._inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self._full = True
+                continue
+
+            if wd == self._hg_wd:
+                if name == 'dirstate':
+                    if ignore_dirstate:
+                        ignored = True
+                    else:
+                        self._full = True
+                continue
+
+            base = self._dirs.get(wd)
+            if base is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._dirs[wd]
+                continue
+            if not name:
+                continue
+
+            if base == '.':
+                path = name
+                if name == '.hgignore':
+                    self._full = True
+            else:
+                path = os.path.join(base, name)
+
+            if mask & IN_ISDIR:
+                if name == '.hg':
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+
+            self._dirty.add(path.decode(encoding))
+
+        return ignored
+
+    def _dirstate_stat(self):
+        try:
+            st = os.stat(os.path.join(self._root, '.hg', 'dirstate'))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _run_status(self, files=None):
+        before = self._dirstate_stat()
+        out = self._client.execute('status', files, print0=True,
+                                   eh=lambda args, ret, out, err: out,
+                                   **self._switches)
+
+        # Running status may itself rewrite the dirstate, and we don't want
+        # that to trigger another full refresh.  We can't tell that apart
+        # from another process (a commit, say) changing it at the same time,
+        # though, so if it has changed, refresh anyway next time.
+        if self._process_events(ignore_dirstate=True) \
+               and self._dirstate_stat() != before:
+            self._full = True
+        return _parse_status(out)
+
+    def _refresh_all(self):
+        self._dirty.clear()
+        self._full = False
+        self._status = dict([(path, status)
+                             for status, path in self._run_status()])
+
+    def _refresh_paths(self, paths):
+        paths = set(paths)
+        self._dirty.clear()
+
+        files = [os.path.join(self._root, path.encode(self._client.encoding))
+                 for path in paths]
+        results = self._run_status(files)
+
+        # Forget what we knew about these paths (and, in case they are
+        # directories, anything beneath them)
+        prefixes = tuple([path + '/' for path in paths])
+        for path in self._status.keys():
+            if path in paths or path.startswith(prefixes):
+                del self._status[path]
+
+        for status, path in results:
+            self._status[path] = status
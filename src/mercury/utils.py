@@ -1,4 +1,5 @@
 import datetime
+import collections
 from mercury.exceptions import *
 
 def every(l, n):
@@ -100,6 +101,84 @@ class LRUCache(object):
     def iterkeys(self):
         return iter(self.cache_keys)
 
+class SizedLRUCache(object):
+    """A least-recently-used cache bounded by the (estimated) total size of
+    its contents, rather than by the number of entries.
+
+    `sizeof' is called to estimate the size of a value when one is stored
+    using the [] syntax; you can also call add() to give the size
+    explicitly.  Values larger than the whole cache are never stored."""
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.cache = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.cache[key] = entry
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        self.add(key, value, self.sizeof(value))
+
+    def __delitem__(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def add(self, key, value, size):
+        """Store `value' under `key', recording its size as `size'.  Returns
+        True if the value was stored."""
+        del self[key]
+
+        if size > self.max_size:
+            return False
+
+        self.cache[key] = (value, size)
+        self.size += size
+        self._evict()
+        return True
+
+    def resize(self, max_size):
+        """Change the maximum size of the cache, evicting entries if
+        necessary."""
+        self.max_size = max_size
+        self._evict()
+
+    def clear(self):
+        self.cache.clear()
+        self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_size:
+            key, (value, size) = self.cache.popitem(last=False)
+            self.size -= size
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __iter__(self):
+        for key, (value, size) in self.cache.iteritems():
+            yield (key, value)
+
+    def iteritems(self):
+        return self.__iter__()
+
+    def iterkeys(self):
+        return self.cache.iterkeys()
+
 _ZERO = datetime.timedelta(0)
 
 class UTC(datetime.tzinfo):
@@ -0,0 +1,30 @@
+import unittest
+
+from mercury import diffparser
+
+class ContextDiffTest(unittest.TestCase):
+    def test_no_newline_at_end_of_file(self):
+        diff = ('diff -c a/f b/f\n'
+                '*** a/f\n'
+                '--- b/f\n'
+                '***************\n'
+                '*** 1,2 ****\n'
+                '  a\n'
+                '! b\n'
+                '\\ No newline at end of file\n'
+                '--- 1,2 ----\n'
+                '  a\n'
+                '! c\n'
+                '\\ No newline at end of file\n')
+        changes = list(diffparser.parse(diff))
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0].kind, 'change')
+
+        hunk, = changes[0].hunks
+        self.assertEqual((hunk.start_a, hunk.len_a, hunk.start_b, hunk.len_b),
+                         (1, 2, 1, 2))
+        self.assertEqual(list(hunk.lines),
+                         [(' ', 'a\n'), ('-', 'b'), ('+', 'c')])
+
+if __name__ == '__main__':
+    unittest.main()
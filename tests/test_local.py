@@ -0,0 +1,21 @@
+import unittest
+
+from mercury import local
+from mercury.queryset import Queryset, RevsQueryset
+
+def _graph(count):
+    infos = [(rev, '%040x' % rev, rev - 1, -1, 'default', 'user', 0.0,
+              'public') for rev in xrange(count)]
+    return local.Graph(infos)
+
+class IntlistTest(unittest.TestCase):
+    def test_evaluated_locally(self):
+        def remote(revset):
+            self.fail('%r was sent to hg' % revset)
+
+        qs = RevsQueryset(Queryset(), [5, 2, 7])
+        self.assertEqual(_graph(10).evaluate(qs._optimized(), remote),
+                         [5, 2, 7])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mercury import Repository
+
+def _hg(path, *args):
+    subprocess.check_call(['hg', '--cwd', path] + list(args),
+                          stdout=open(os.devnull, 'w'))
+
+def _write(path, name, text):
+    f = open(os.path.join(path, name), 'wb')
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+class GrepTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        _hg(self.path, 'init')
+        _write(self.path, 'a.txt', 'one\nfoo two\n')
+        _hg(self.path, 'commit', '-A', '-m', 'first',
+            '-u', 'Alice <alice@example.com>', '-d', '1000000 -3600')
+        _write(self.path, 'a.txt', 'one\nfoo three\nfoo four\n')
+        _write(self.path, 'b.txt', 'foo five\n')
+        _hg(self.path, 'commit', '-A', '-m', 'second',
+            '-u', 'Bob <bob@example.com>', '-d', '2000000 0')
+        self.repo = Repository(self.path)
+
+    def tearDown(self):
+        self.repo.close()
+        shutil.rmtree(self.path)
+
+    def test_fields(self):
+        # hg prints the file, rev, line, type, user and date in that order,
+        # whichever of them we ask for
+        matches = list(self.repo.grep('foo', rev=[0],
+                                      annotations=['date', 'user', 'line',
+                                                   'file', 'rev']))
+        self.assertEqual(len(matches), 1)
+        match = matches[0]
+        self.assertEqual(match, 'foo two')
+        self.assertEqual(match.file, 'a.txt')
+        self.assertEqual(match.rev, 0)
+        self.assertEqual(match.line, 2)
+        self.assertEqual(match.user, 'Alice <alice@example.com>')
+        self.assertEqual(match.date.strftime('%Y-%m-%d %H:%M:%S'),
+                         '1970-01-12 14:46:40')
+        self.assertEqual(match.date.utcoffset().seconds, 3600)
+
+    def test_type_scans_all_revisions(self):
+        # Asking for the type passes --all, so we see every change
+        matches = list(self.repo.grep('foo', annotations=['rev', 'file',
+                                                          'line', 'type']))
+        found = sorted([(m.rev, m.file, m.line, m.type, str(m))
+                        for m in matches])
+        self.assertEqual(found,
+                         [(0, 'a.txt', 2, '+', 'foo two'),
+                          (1, 'a.txt', 2, '+', 'foo three'),
+                          (1, 'a.txt', 2, '-', 'foo two'),
+                          (1, 'a.txt', 3, '+', 'foo four'),
+                          (1, 'b.txt', 1, '+', 'foo five')])
+
+    def test_repository_usable_while_iterating(self):
+        found = []
+        for match in self.repo.grep('foo', annotations=['rev', 'file']):
+            found.append((match.file, self.repo[match.rev].desc))
+        self.assertEqual(sorted(found),
+                         [('a.txt', 'second'), ('a.txt', 'second'),
+                          ('b.txt', 'second')])
+
+if __name__ == '__main__':
+    unittest.main()